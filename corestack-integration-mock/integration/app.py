@@ -50,10 +50,11 @@ def startup():
 @app.post("/ingest", response_model=IngestResult)
 def ingest_endpoint(path: str = Query(..., description="Path to custodian run output directory")):
     """Ingest Cloud Custodian run outputs from a local path."""
-    if not os.path.isdir(path):
+    archived = not os.path.isdir(path) and ingest.runfiles.archived_run(path)
+    if not os.path.isdir(path) and not archived:
         raise HTTPException(status_code=400, detail=f"Directory not found: {path}")
     manifest = os.path.join(path, "manifest.json")
-    if not os.path.exists(manifest):
+    if not archived and not os.path.exists(manifest):
         raise HTTPException(status_code=400, detail=f"manifest.json not found in: {path}")
     try:
         result = ingest.ingest_run(path)
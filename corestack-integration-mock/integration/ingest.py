@@ -2,24 +2,86 @@
 
 import json
 import os
+import sys
 import logging
+import tempfile
 
 from . import store, normalize
 
+# Run-directory readers live with the POC scripts that write the runs. Their
+# directory goes last on the path so none of its modules shadow this app's own.
+POC_SCRIPTS = os.path.abspath(os.environ.get(
+    "CUSTODIAN_POC_SCRIPTS", os.path.join(os.path.dirname(__file__), "..", "..", "scripts")))
+if POC_SCRIPTS not in map(os.path.abspath, sys.path):
+    sys.path.append(POC_SCRIPTS)
+import runfiles  # noqa: E402
+import runindex  # noqa: E402
+
 log = logging.getLogger(__name__)
 
+# Raw resources kept as evidence per policy and run. Every resource is still
+# stored as a row; the cap keeps ingest memory flat for huge outputs, and
+# evidence cut short by it says so (see evidence_json).
+EVIDENCE_LIMIT = 1000
+
+
+def evidence_json(evidence: list, total: int) -> str:
+    """Evidence as stored: the raw resources as a JSON array.
+
+    When there were more than were kept, it is
+    ``{"truncated": true, "total": <violations>, "resources": [...]}`` instead.
+    """
+    if total > len(evidence):
+        return json.dumps({"truncated": True, "total": total, "resources": evidence}, default=str)
+    return json.dumps(evidence, default=str)
+
 
-def ingest_run(run_dir: str) -> dict:
+def dry_run_counts(manifest: dict, run_dir: str) -> dict:
+    """What ingest_run would load, read from the run's digest.json.
+
+    Only runs written without a digest have their resources.json files parsed.
+    """
+    digest = runfiles.read_digest(run_dir) or {}
+    outputs = runfiles.policy_outputs(manifest, run_dir)
+    resources = 0
+    for output in outputs:
+        entry = digest.get(os.path.relpath(output["path"], run_dir))
+        if entry is not None:
+            resources += entry["violations"] or 0
+        else:
+            resources += runfiles.count_resources(output["path"]) or 0
+    policies = len({o["name"] for o in outputs})
+    return {
+        "status": "dry-run",
+        "run_id": manifest["run_id"],
+        "policies_ingested": policies,
+        "findings_ingested": policies,
+        "resources_ingested": resources,
+    }
+
+
+def ingest_run(run_dir: str, dry_run: bool = False) -> dict:
     """Read a custodian run directory and load everything into SQLite.
 
-    Returns a summary dict with counts.
+    Returns a summary dict with counts. A run compacted by
+    compact_outputs.py is read from its day archive. With ``dry_run``
+    nothing is written and the counts come from the run's digest.
     """
+    if not os.path.isdir(run_dir):
+        archive = runfiles.archived_run(run_dir)
+        if archive:
+            with tempfile.TemporaryDirectory() as tmp:
+                return ingest_run(runfiles.extract_run(archive, os.path.basename(os.path.normpath(run_dir)), tmp),
+                                  dry_run)
+
     manifest_path = os.path.join(run_dir, "manifest.json")
     if not os.path.exists(manifest_path):
         raise FileNotFoundError(f"manifest.json not found in {run_dir}")
 
     with open(manifest_path) as f:
         manifest = json.load(f)
+    if dry_run:
+        return dry_run_counts(manifest, run_dir)
 
     run_id = manifest["run_id"]
     timestamp = manifest["timestamp"]
@@ -34,18 +96,37 @@ def ingest_run(run_dir: str) -> dict:
         findings_ingested = 0
         resources_ingested = 0
 
-        for policy_name in manifest.get("policies_run", []):
-            policy_dir = os.path.join(run_dir, policy_name)
+        # Multi-account/region runs have one output directory per policy,
+        # account and region; each policy gets a single finding aggregated
+        # across all of them.
+        outputs_by_policy = {}
+        for output in runfiles.policy_outputs(manifest, run_dir):
+            outputs_by_policy.setdefault(output["name"], []).append(output)
+
+        for policy_name, outputs in outputs_by_policy.items():
+            # Incremental runs mark outputs reused from an earlier run. If every
+            # output of the policy came from the same, already ingested run,
+            # copy its rows instead of parsing the outputs again.
+            reused_from = {(o["result"] or {}).get("reused_from") for o in outputs}
+            if len(reused_from) == 1 and None not in reused_from:
+                policy_id = normalize.make_policy_id(policy_name)
+                copied = store.copy_policy_results(conn, policy_id, reused_from.pop(), run_id)
+                if copied is not None:
+                    policies_ingested += 1
+                    findings_ingested += 1
+                    resources_ingested += copied
+                    continue
 
             # Read metadata for policy details
-            metadata_path = os.path.join(policy_dir, "metadata.json")
-            if not os.path.exists(metadata_path):
+            metadata = None
+            for output in outputs:
+                metadata = runfiles.read_json(output["path"], "metadata.json")
+                if metadata is not None:
+                    break
+            if metadata is None:
                 log.warning(f"No metadata.json for policy {policy_name}, skipping")
                 continue
 
-            with open(metadata_path) as f:
-                metadata = json.load(f)
-
             policy_meta = metadata.get("policy", {})
             policy_id = normalize.make_policy_id(policy_name)
             severity = normalize.extract_severity(policy_meta)
@@ -60,33 +141,36 @@ def ingest_run(run_dir: str) -> dict:
             )
             policies_ingested += 1
 
-            # Read resources (violations)
-            resources_path = os.path.join(policy_dir, "resources.json")
-            resources = []
-            if os.path.exists(resources_path):
-                with open(resources_path) as f:
-                    resources = json.load(f)
-
-            violations_count = len(resources)
+            evidence = []
+            violations_count = 0
+            for output in outputs:
+                if runfiles.find_output(output["path"], "resources.json") is None:
+                    # Archives past raw retention keep only the count, in metadata.json.
+                    violations_count += runfiles.resource_count(runfiles.read_json(output["path"], "metadata.json"))
+                    continue
+
+                # Stream resources (violations), plain or compressed, one at a time
+                for res in runfiles.iter_resources(output["path"]):
+                    raw_id = runfiles.resource_id(res, resource_type_raw)
+                    resource_key = normalize.make_resource_key(
+                        output["account_id"], output["region"], resource_type, raw_id)
+                    tags_json = normalize.extract_tags_json(res)
+
+                    store.upsert_resource(
+                        conn, resource_key, policy_id, run_id, raw_id,
+                        resource_type, output["region"], output["account_id"], tags_json,
+                    )
+                    resources_ingested += 1
+                    violations_count += 1
+                    if len(evidence) < EVIDENCE_LIMIT:
+                        evidence.append(res)
             status = normalize.determine_status(violations_count)
 
             store.upsert_finding(conn, run_id, policy_id, status, violations_count, timestamp)
             findings_ingested += 1
 
-            # Store individual resources
-            for res in resources:
-                raw_id = normalize.extract_raw_id(res, resource_type_raw)
-                resource_key = normalize.make_resource_key(account_id, region, resource_type, raw_id)
-                tags_json = normalize.extract_tags_json(res)
-
-                store.upsert_resource(
-                    conn, resource_key, policy_id, run_id, raw_id,
-                    resource_type, region, account_id, tags_json,
-                )
-                resources_ingested += 1
-
-            # Store evidence (full raw output)
-            store.upsert_evidence(conn, policy_id, run_id, json.dumps(resources, default=str))
+            # Store evidence: the raw output, marked as truncated past EVIDENCE_LIMIT
+            store.upsert_evidence(conn, policy_id, run_id, evidence_json(evidence, violations_count))
 
         conn.commit()
         log.info(f"Ingested run {run_id}: {policies_ingested} policies, "
@@ -101,3 +185,20 @@ def ingest_run(run_dir: str) -> dict:
         }
     finally:
         conn.close()
+
+
+def ingest_index(outputs_dir: str) -> list[dict]:
+    """Ingest every complete run in the outputs/ run index that the store does not have yet.
+
+    Runs are found through outputs/index.db, without listing run directories.
+    """
+    conn = store.get_db()
+    try:
+        known = {row[0] for row in conn.execute("SELECT run_id FROM runs")}
+    finally:
+        conn.close()
+    results = []
+    for run in reversed(runindex.list_runs(outputs_dir, complete=True)):
+        if run["run_id"] not in known:
+            results.append(ingest_run(runindex.run_dir(outputs_dir, run)))
+    return results
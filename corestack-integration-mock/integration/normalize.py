@@ -56,24 +56,6 @@ def detect_resource_type(policy_resource: str) -> str:
     return mapping.get(policy_resource, policy_resource)
 
 
-def extract_raw_id(resource: dict, resource_type: str) -> str:
-    """Pull the primary identifier from a custodian resource blob."""
-    # S3
-    if "Name" in resource and resource_type == "s3":
-        return resource["Name"]
-    # EC2
-    if "InstanceId" in resource:
-        return resource["InstanceId"]
-    # EBS
-    if "VolumeId" in resource:
-        return resource["VolumeId"]
-    # Fallback
-    for key in ("ResourceId", "Id", "Arn"):
-        if key in resource:
-            return resource[key]
-    return "unknown"
-
-
 def extract_tags_json(resource: dict) -> str:
     """Extract tags from a custodian resource as JSON string."""
     tags = resource.get("Tags", [])
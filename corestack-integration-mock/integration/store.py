@@ -125,6 +125,35 @@ def upsert_evidence(conn, policy_id, run_id, evidence_json):
     """, (policy_id, run_id, evidence_json))
 
 
+def copy_policy_results(conn, policy_id, from_run_id, to_run_id) -> Optional[int]:
+    """Carry a policy's finding, resources and evidence over from an earlier run.
+
+    Returns the number of resources copied, or None if the earlier run has no
+    finding for the policy (i.e. it was never ingested).
+    """
+    cur = conn.execute("""
+        INSERT INTO findings (run_id, policy_id, status, violations_count, last_evaluated)
+        SELECT ?, policy_id, status, violations_count, last_evaluated
+        FROM findings WHERE run_id = ? AND policy_id = ?
+        ON CONFLICT(run_id, policy_id) DO UPDATE SET
+            status=excluded.status, violations_count=excluded.violations_count,
+            last_evaluated=excluded.last_evaluated
+    """, (to_run_id, from_run_id, policy_id))
+    if cur.rowcount == 0:
+        return None
+    cur = conn.execute("""
+        INSERT OR REPLACE INTO resources (resource_key, policy_id, run_id, raw_id, type, region, account_id, tags_json)
+        SELECT resource_key, policy_id, ?, raw_id, type, region, account_id, tags_json
+        FROM resources WHERE run_id = ? AND policy_id = ?
+    """, (to_run_id, from_run_id, policy_id))
+    copied = cur.rowcount
+    conn.execute("""
+        INSERT OR REPLACE INTO evidence (policy_id, run_id, evidence_json)
+        SELECT policy_id, ?, evidence_json FROM evidence WHERE run_id = ? AND policy_id = ?
+    """, (to_run_id, from_run_id, policy_id))
+    return copied
+
+
 # ── Queries ──────────────────────────────────────────────────────────────────
 
 def get_summary(conn) -> dict:
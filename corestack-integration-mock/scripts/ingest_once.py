@@ -14,25 +14,44 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname
 
 
 def main():
+    args = [a for a in sys.argv[1:] if a != "--dry-run"]
+    dry_run = len(args) < len(sys.argv) - 1
     run_dir = os.environ.get("CUSTODIAN_RUN_DIR")
     if not run_dir:
-        if len(sys.argv) > 1:
-            run_dir = sys.argv[1]
+        if args:
+            run_dir = args[0]
         else:
-            print("Usage: python ingest_once.py <path_to_custodian_run_dir>")
+            print("Usage: python ingest_once.py [--dry-run] <path_to_custodian_run_dir | path_to_outputs_dir>")
             print("  or set CUSTODIAN_RUN_DIR environment variable")
             sys.exit(1)
 
-    if not os.path.isdir(run_dir):
+    if not os.path.isdir(run_dir) and not ingest.runfiles.archived_run(run_dir):
         print(f"ERROR: Directory not found: {run_dir}")
         sys.exit(1)
 
+    if dry_run:
+        # Counts from the run's digest.json; the database is not touched.
+        result = ingest.ingest_run(run_dir, dry_run=True)
+        print(f"Dry run of {result['run_id']}: would ingest {result['findings_ingested']} findings, "
+              f"{result['resources_ingested']} resources")
+        return
+
     print(f"Initializing database...")
     store.init_db()
 
     print(f"Seeding CoreStack-native policies...")
     seed_corestack.seed()
 
+    if os.path.exists(os.path.join(run_dir, ingest.runindex.INDEX_FILE)):
+        # An outputs/ directory: ingest every indexed run not loaded yet.
+        print(f"Ingesting new runs from the index in: {run_dir}")
+        results = ingest.ingest_index(run_dir)
+        for result in results:
+            print(f"  {result['run_id']}: {result['findings_ingested']} findings, "
+                  f"{result['resources_ingested']} resources")
+        print(f"\nIngestion complete: {len(results)} new run(s).")
+        return
+
     print(f"Ingesting custodian run from: {run_dir}")
     result = ingest.ingest_run(run_dir)
 
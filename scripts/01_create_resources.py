@@ -1,12 +1,86 @@
 #!/usr/bin/env python3
-"""Create demo AWS resources: S3 bucket, EC2 instance, EBS volume."""
+"""Create demo AWS resources: S3 bucket, EC2 instance, EBS volume.
 
+The bucket is set up while the instance and its volume are launched, and
+steps that depend on AWS catching up (a new bucket becoming visible, a
+public access block change propagating, a volume becoming available) poll
+with backoff instead of sleeping a fixed time. Set AWS_ENDPOINT_URL to run
+against a local stand-in such as moto.
+"""
+
+import argparse
 import json
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from botocore.exceptions import ClientError
-from common import get_region, TAGS, TAGS_LIST, SAFE_MODE, PREFIX, save_state
+from common import get_region, utc_iso, TAGS, TAGS_LIST, SAFE_MODE, PREFIX, load_state, save_state, STATE_FILE
+from common import instance_states, volume_states, wait_all, wait_for, when_ready
+from throttle import Throttle, configure_retries
+
+# state.json keys of the demo set, and the fleet list each resource id belongs in.
+DEMO_KEYS = {"bucket_name": "buckets", "instance_id": "instances", "volume_id": "volumes"}
+
+# Fleet mode: the resource kind each policy judges.
+FLEET_POLICIES = {
+    "s3-public-bucket": "buckets",
+    "s3-default-encryption-enabled": "buckets",
+    "ec2-required-tags": "instances",
+    "ebs-unused-volumes": "volumes",
+    "ebs-encrypted": "volumes",
+}
+DEFAULT_FAIL_RATE = 0.5
+INSTANCE_BATCH = 50    # instances per RunInstances call
+DEVICE_NAMES = [f"/dev/sd{c}" for c in "fghijklmnop"]  # volume attachment slots per fleet instance
+
+
+class TrackedState:
+    """state.json, merged into and saved as each resource is created.
+
+    Whatever a run gets to create is on disk for 99_cleanup.py even if the
+    run is interrupted, and fields already there (such as last_run_*) are
+    kept. Resources of a cleaned-up state are dropped.
+    """
+
+    def __init__(self, **fields):
+        self.state = load_state()
+        if self.state.pop("cleaned_up", False):
+            for key in list(DEMO_KEYS) + ["availability_zone", "fleet"]:
+                self.state.pop(key, None)
+        self.state.update(fields)
+        self.added = {}  # fleet ids added by this run, per kind
+        self._lock = threading.Lock()
+        self.save()
+
+    def save(self):
+        save_state(self.state, quiet=True)
+
+    def set(self, **fields):
+        with self._lock:
+            self.state.update(fields)
+            self.save()
+
+    def add(self, kind, ids):
+        """Add resource ids to the fleet list ``kind`` (buckets, instances or volumes)."""
+        with self._lock:
+            self.state.setdefault("fleet", {}).setdefault(kind, []).extend(ids)
+            self.added[kind] = self.added.get(kind, 0) + len(ids)
+            self.save()
+
+    def set_fleet(self, **fields):
+        with self._lock:
+            self.state.setdefault("fleet", {}).update(fields)
+            self.save()
+
+    def keep_demo(self):
+        """Move the ids of a demo set that was never cleaned up to the fleet lists, so cleanup still finds them."""
+        with self._lock:
+            for key, kind in DEMO_KEYS.items():
+                if self.state.get(key):
+                    self.state.setdefault("fleet", {}).setdefault(kind, []).append(self.state.pop(key))
+            self.save()
 
 
 def get_ami_from_ssm(region):
@@ -47,60 +121,76 @@ def get_latest_amazon_linux_ami(ec2, region):
     return None
 
 
-def create_s3_bucket(s3, bucket_name, region):
-    """Create S3 bucket with encryption, optionally public."""
-    print(f"Creating S3 bucket: {bucket_name}")
-
+def new_bucket(s3, bucket_name, region):
     create_args = {"Bucket": bucket_name}
     if region != "us-east-1":
         create_args["CreateBucketConfiguration"] = {"LocationConstraint": region}
-
     s3.create_bucket(**create_args)
 
-    # Tag the bucket
-    s3.put_bucket_tagging(
+
+def tag_bucket(s3, bucket_name, tags):
+    """Tag a bucket (a new bucket can take a moment to be visible everywhere)."""
+    when_ready(lambda: s3.put_bucket_tagging(
         Bucket=bucket_name,
-        Tagging={"TagSet": [{"Key": k, "Value": v} for k, v in TAGS.items()]},
-    )
+        Tagging={"TagSet": [{"Key": k, "Value": v} for k, v in tags.items()]},
+    ), ("NoSuchBucket",))
+
 
-    # Enable default encryption (SSE-S3) -> policy #2 will PASS
-    s3.put_bucket_encryption(
+def enable_encryption(s3, bucket_name):
+    """Default encryption (SSE-S3) -> s3-default-encryption-enabled PASSes."""
+    when_ready(lambda: s3.put_bucket_encryption(
         Bucket=bucket_name,
         ServerSideEncryptionConfiguration={
             "Rules": [
                 {"ApplyServerSideEncryptionByDefault": {"SSEAlgorithm": "AES256"}, "BucketKeyEnabled": True}
             ]
         },
-    )
+    ), ("NoSuchBucket",))
+
+
+def make_public(s3, bucket_name):
+    """Public-read bucket policy -> s3-public-bucket FAILs."""
+    # First disable the public access block so we can set a public policy
+    when_ready(lambda: s3.put_public_access_block(
+        Bucket=bucket_name,
+        PublicAccessBlockConfiguration={
+            "BlockPublicAcls": False,
+            "IgnorePublicAcls": False,
+            "BlockPublicPolicy": False,
+            "RestrictPublicBuckets": False,
+        },
+    ), ("NoSuchBucket",))
+
+    policy = {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Sid": "PublicReadDemo",
+                "Effect": "Allow",
+                "Principal": "*",
+                "Action": "s3:GetObject",
+                "Resource": f"arn:aws:s3:::{bucket_name}/*",
+            }
+        ],
+    }
+    # Denied until the public access block change has propagated
+    when_ready(lambda: s3.put_bucket_policy(Bucket=bucket_name, Policy=json.dumps(policy)),
+               ("AccessDenied", "NoSuchBucket"))
+
+
+def create_s3_bucket(s3, bucket_name, region, tracked):
+    """Create S3 bucket with encryption, optionally public."""
+    print(f"Creating S3 bucket: {bucket_name}")
+    new_bucket(s3, bucket_name, region)
+    tracked.set(bucket_name=bucket_name)
+    tag_bucket(s3, bucket_name, TAGS)
+
+    enable_encryption(s3, bucket_name)
     print("  Default encryption (AES256) enabled.")
 
     # Make public if not SAFE_MODE -> policy #1 will FAIL
     if not SAFE_MODE:
-        # First disable the public access block so we can set a public policy
-        s3.put_public_access_block(
-            Bucket=bucket_name,
-            PublicAccessBlockConfiguration={
-                "BlockPublicAcls": False,
-                "IgnorePublicAcls": False,
-                "BlockPublicPolicy": False,
-                "RestrictPublicBuckets": False,
-            },
-        )
-        time.sleep(2)  # allow propagation
-
-        policy = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Sid": "PublicReadDemo",
-                    "Effect": "Allow",
-                    "Principal": "*",
-                    "Action": "s3:GetObject",
-                    "Resource": f"arn:aws:s3:::{bucket_name}/*",
-                }
-            ],
-        }
-        s3.put_bucket_policy(Bucket=bucket_name, Policy=json.dumps(policy))
+        make_public(s3, bucket_name)
         print("  Public-read bucket policy applied (demo only).")
     else:
         print("  SAFE_MODE=true: skipping public access.")
@@ -108,12 +198,11 @@ def create_s3_bucket(s3, bucket_name, region):
     return bucket_name
 
 
-def create_ec2_instance(ec2, prefix, region):
+def create_ec2_instance(ec2, prefix, region, tracked):
     """Create a t3.micro instance missing the CostCenter tag so policy #3 FAILs."""
     ami_id = get_latest_amazon_linux_ami(ec2, region)
     if not ami_id:
-        print("ERROR: Could not find Amazon Linux AMI.")
-        sys.exit(1)
+        raise RuntimeError("Could not find Amazon Linux AMI.")
 
     instance_name = f"{prefix}-demo-instance"
     # Deliberately OMIT CostCenter tag so ec2-required-tags policy fails
@@ -131,11 +220,12 @@ def create_ec2_instance(ec2, prefix, region):
     )
     instance_id = resp["Instances"][0]["InstanceId"]
     az = resp["Instances"][0]["Placement"]["AvailabilityZone"]
+    tracked.set(instance_id=instance_id, availability_zone=az)
     print(f"  Instance launched: {instance_id} in {az}")
     return instance_id, az
 
 
-def create_ebs_volume(ec2, prefix, az):
+def create_ebs_volume(ec2, prefix, az, tracked):
     """Create an encrypted but unattached EBS volume.
     - ebs-encrypted policy -> PASS (encrypted=True)
     - ebs-unused-volumes policy -> FAIL (unattached)
@@ -152,11 +242,232 @@ def create_ebs_volume(ec2, prefix, az):
         TagSpecifications=[{"ResourceType": "volume", "Tags": tags}],
     )
     volume_id = resp["VolumeId"]
+    tracked.set(volume_id=volume_id)
+    # ebs-unused-volumes only matches volumes in the "available" state
+    wait_for(lambda: volume_states(ec2, [volume_id]).get(volume_id) == "available", f"volume {volume_id}")
     print(f"  Volume created: {volume_id}")
     return volume_id
 
 
+def create_instance_and_volume(ec2, prefix, region, tracked):
+    """The volume goes in the instance's availability zone, so these two run in order."""
+    instance_id, az = create_ec2_instance(ec2, prefix, region, tracked)
+    return instance_id, az, create_ebs_volume(ec2, prefix, az, tracked)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buckets", type=int, default=0,
+                        help="fleet mode: number of S3 buckets to create")
+    parser.add_argument("--instances", type=int, default=0,
+                        help="fleet mode: number of EC2 instances to create")
+    parser.add_argument("--volumes", type=int, default=0,
+                        help="fleet mode: number of EBS volumes to create")
+    parser.add_argument("--fail-rate", action="append", default=[], metavar="[POLICY=]RATE",
+                        help="fleet mode: share of resources set up to fail every policy, or just POLICY "
+                             f"(repeatable; default: {DEFAULT_FAIL_RATE})")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="fleet mode: concurrent API calls (default: 16)")
+    parser.add_argument("--rate-limit", type=float, default=20,
+                        help="fleet mode: API calls/s per service, halved on throttling and recovered "
+                             "gradually (default: 20)")
+    args = parser.parse_args()
+    if min(args.buckets, args.instances, args.volumes) < 0:
+        parser.error("resource counts must not be negative")
+
+    rates = dict.fromkeys(FLEET_POLICIES, DEFAULT_FAIL_RATE)
+    for value in sorted(args.fail_rate, key=lambda v: "=" in v):  # every-policy rates first
+        policy, _, rate = value.rpartition("=")
+        if policy and policy not in FLEET_POLICIES:
+            parser.error(f"--fail-rate: unknown policy {policy!r} (one of: {', '.join(FLEET_POLICIES)})")
+        try:
+            rate = float(rate)
+        except ValueError:
+            rate = -1
+        if not 0 <= rate <= 1:
+            parser.error(f"--fail-rate: {value!r} is not a rate between 0 and 1")
+        rates.update({policy: rate} if policy else dict.fromkeys(FLEET_POLICIES, rate))
+    args.fail_rates = rates
+    return args
+
+
+def fails(i, rate):
+    """Whether resource ``i`` of a kind is set up to fail: floor(n * rate) of any first n do, spread evenly."""
+    return int((i + 1) * rate) > int(i * rate)
+
+
+def fleet_bucket(s3, bucket_name, region, public, encrypted, tracked):
+    new_bucket(s3, bucket_name, region)
+    tracked.add("buckets", [bucket_name])
+    tag_bucket(s3, bucket_name, TAGS)
+    if encrypted:
+        enable_encryption(s3, bucket_name)
+    if public:
+        make_public(s3, bucket_name)
+
+
+def fleet_instances(ec2, ami_id, count, tagged, prefix, tracked):
+    """Launch ``count`` instances in one call; ``tagged`` ones carry the tags ec2-required-tags wants."""
+    tags = TAGS_LIST + [{"Key": "Name", "Value": f"{prefix}-fleet-instance"}]
+    if tagged:
+        tags += [{"Key": "CostCenter", "Value": "fleet"}, {"Key": "Environment", "Value": "loadtest"}]
+    resp = ec2.run_instances(
+        ImageId=ami_id,
+        InstanceType="t3.micro",
+        MinCount=count,
+        MaxCount=count,
+        TagSpecifications=[{"ResourceType": "instance", "Tags": tags}],
+    )
+    instances = [(i["InstanceId"], i["Placement"]["AvailabilityZone"]) for i in resp["Instances"]]
+    tracked.add("instances", [instance_id for instance_id, _ in instances])
+    return instances
+
+
+def fleet_volume(ec2, prefix, az, encrypted, tracked):
+    resp = ec2.create_volume(
+        AvailabilityZone=az,
+        Size=1,
+        VolumeType="gp3",
+        Encrypted=encrypted,
+        TagSpecifications=[{"ResourceType": "volume",
+                            "Tags": TAGS_LIST + [{"Key": "Name", "Value": f"{prefix}-fleet-volume"}]}],
+    )
+    tracked.add("volumes", [resp["VolumeId"]])
+    return resp["VolumeId"]
+
+
+def results(futures, errors):
+    """Results of the futures that succeeded; exceptions of the others go to ``errors``."""
+    done = []
+    for future in futures:
+        try:
+            done.append(future.result())
+        except Exception as e:
+            errors.append(e)
+    return done
+
+
+def create_ec2_fleet(args, ec2, region, prefix, rates, pool, tracked, expected, errors):
+    """Launch the fleet's instances, then create its volumes and attach the ones meant to be in use."""
+    instances = []
+    if args.instances:
+        ami_id = get_latest_amazon_linux_ami(ec2, region)
+        if not ami_id:
+            raise RuntimeError("Could not find Amazon Linux AMI.")
+        untagged = sum(fails(i, rates["ec2-required-tags"]) for i in range(args.instances))
+        expected["ec2-required-tags"] = untagged
+        launches = []
+        for tagged, count in ((False, untagged), (True, args.instances - untagged)):
+            for offset in range(0, count, INSTANCE_BATCH):
+                launches.append(pool.submit(fleet_instances, ec2, ami_id, min(INSTANCE_BATCH, count - offset),
+                                            tagged, prefix, tracked))
+        instances = [i for batch in results(launches, errors) for i in batch]
+        print(f"Instances: {len(instances)} launched")
+
+    if not args.volumes:
+        return
+    default_az = instances[0][1] if instances else \
+        ec2.describe_availability_zones()["AvailabilityZones"][0]["ZoneName"]
+    # Volumes meant to pass ebs-unused-volumes are attached, as far as the fleet's instances have slots.
+    slots = iter([(instance_id, az, device) for device in DEVICE_NAMES for instance_id, az in instances])
+    plan, short = [], 0
+    for i in range(args.volumes):
+        slot = None if fails(i, rates["ebs-unused-volumes"]) else next(slots, None)
+        short += slot is None and not fails(i, rates["ebs-unused-volumes"])
+        encrypted = not fails(i, rates["ebs-encrypted"])
+        expected["ebs-unused-volumes"] += slot is None
+        expected["ebs-encrypted"] += not encrypted
+        plan.append((slot, pool.submit(fleet_volume, ec2, prefix, slot[1] if slot else default_az,
+                                       encrypted, tracked)))
+    if short:
+        print(f"Volumes: {short} left unattached for lack of instance slots ({len(DEVICE_NAMES)} per instance)")
+
+    attach = []
+    for slot, future in plan:
+        try:
+            volume_id = future.result()
+        except Exception as e:
+            errors.append(e)
+            continue
+        if slot:
+            attach.append((volume_id, slot))
+    print(f"Volumes: {tracked.added.get('volumes', 0)} created")
+    if attach:
+        wait_all(list(dict.fromkeys(slot[0] for _, slot in attach)),
+                 lambda batch: instance_states(ec2, batch), "running", "instances")
+        wait_all([volume_id for volume_id, _ in attach],
+                 lambda batch: volume_states(ec2, batch), "available", "volumes")
+        results([pool.submit(ec2.attach_volume, VolumeId=volume_id, InstanceId=slot[0], Device=slot[2])
+                 for volume_id, slot in attach], errors)
+        print(f"Volumes: {len(attach)} attached")
+
+
+def create_fleet(args, region, prefix):
+    """Create the requested numbers of buckets, instances and volumes, each mix set by --fail-rate."""
+    rates = args.fail_rates
+    if SAFE_MODE and rates["s3-public-bucket"]:
+        print("SAFE_MODE=true: no bucket is made public.")
+        rates["s3-public-bucket"] = 0.0
+    print(f"Fleet: {args.buckets} buckets, {args.instances} instances, {args.volumes} volumes")
+    print("Fail rates: " + ", ".join(f"{p} {r:g}" for p, r in rates.items()))
+    print()
+
+    throttle = Throttle(args.rate_limit)
+    configure_retries()
+    session = boto3.Session(region_name=region)
+    throttle.session_hook(lambda service: None)(session)
+    s3 = session.client("s3")
+    ec2 = session.client("ec2")
+
+    # Merged into state.json, which is saved after every create call and launch batch.
+    tracked = TrackedState(prefix=prefix, region=region, safe_mode=SAFE_MODE, created_at=utc_iso())
+    tracked.keep_demo()
+    tracked.set_fleet(fail_rates=rates)
+    expected = dict.fromkeys(FLEET_POLICIES, 0)
+    errors = []
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        try:
+            bucket_futures = []
+            for i in range(args.buckets):
+                public = fails(i, rates["s3-public-bucket"])
+                encrypted = not fails(i, rates["s3-default-encryption-enabled"])
+                expected["s3-public-bucket"] += public
+                expected["s3-default-encryption-enabled"] += not encrypted
+                bucket_futures.append(pool.submit(fleet_bucket, s3, f"{prefix}-fleet-{i:05d}", region,
+                                                  public, encrypted, tracked))
+            # Buckets keep being created while instances launch, and then volumes are created.
+            try:
+                create_ec2_fleet(args, ec2, region, prefix, rates, pool, tracked, expected, errors)
+            except Exception as e:  # the buckets still finish, and everything created is in state
+                errors.append(e)
+            results(bucket_futures, errors)
+            print(f"Buckets: {tracked.added.get('buckets', 0)} created")
+        except KeyboardInterrupt:
+            # Stop launching: calls already running finish and their ids are saved.
+            pool.shutdown(cancel_futures=True)
+            print(f"\nInterrupted; the resources created so far are in {STATE_FILE} for 99_cleanup.py.")
+            sys.exit(130)
+
+    tracked.set_fleet(expected_violations=expected)
+    print(f"State saved to {STATE_FILE}")
+
+    summary = throttle.summary()
+    print()
+    print(f"Fleet created in {time.time() - started:.1f}s "
+          f"({summary['events']} throttled calls, rates now {summary.get('rates', {})}).")
+    print("Expected violations: " + ", ".join(f"{p} {n}" for p, n in expected.items()))
+    if tracked.added.get("instances"):
+        print("  (ebs-encrypted also matches the instances' root volumes unless EBS encryption by default is on)")
+    if errors:
+        print(f"\n{len(errors)} step(s) failed; the resources created are in state.json for 99_cleanup.py:")
+        for e in errors[:5]:
+            print(f"  ERROR: {e}")
+        sys.exit(1)
+
+
 def main():
+    args = parse_args()
     region = get_region()
     prefix = PREFIX
 
@@ -165,26 +476,32 @@ def main():
     print(f"SAFE_MODE: {SAFE_MODE}")
     print()
 
+    if args.buckets or args.instances or args.volumes:
+        create_fleet(args, region, prefix)
+        return
+
     s3 = boto3.client("s3", region_name=region)
     ec2 = boto3.client("ec2", region_name=region)
 
     bucket_name = f"{prefix}-public-bucket"
-    bucket = create_s3_bucket(s3, bucket_name, region)
-
-    instance_id, az = create_ec2_instance(ec2, prefix, region)
-    volume_id = create_ebs_volume(ec2, prefix, az)
-
-    state = {
-        "prefix": prefix,
-        "region": region,
-        "safe_mode": SAFE_MODE,
-        "bucket_name": bucket,
-        "instance_id": instance_id,
-        "volume_id": volume_id,
-        "availability_zone": az,
-        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
-    }
-    save_state(state)
+    # Each id is saved as soon as its resource exists, so 99_cleanup.py can remove it.
+    tracked = TrackedState(prefix=prefix, region=region, safe_mode=SAFE_MODE, created_at=utc_iso())
+    tracked.keep_demo()
+
+    # The bucket and the instance/volume pair don't depend on each other.
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        bucket_future = pool.submit(create_s3_bucket, s3, bucket_name, region, tracked)
+        ec2_future = pool.submit(create_instance_and_volume, ec2, prefix, region, tracked)
+    errors = [f.exception() for f in (bucket_future, ec2_future) if f.exception()]
+    if errors:
+        print(f"State saved to {STATE_FILE} with the resources created so far.")
+        for e in errors:
+            print(f"ERROR: {e}")
+        sys.exit(1)
+
+    bucket = bucket_future.result()
+    instance_id, az, volume_id = ec2_future.result()
+    print(f"State saved to {STATE_FILE}")
 
     print()
     print("All resources created successfully.")
@@ -1,93 +1,1228 @@
 #!/usr/bin/env python3
 """Run Cloud Custodian policies and capture outputs."""
 
+import argparse
 import json
+import logging
 import os
+import pickle
+import re
+import shutil
 import subprocess
 import sys
 import time
 import glob
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import boto3
-from common import load_state, get_region, POLICIES_DIR, OUTPUTS_DIR
+import yaml
+from accounts import load_accounts, RoleCredentials
+from incremental import (
+    inventory_fingerprints, load_store as load_reuse_store, save_store as save_reuse_store,
+    make_record, reusable, reuse_outputs, store_key,
+)
+import evaluator
+import recording
+from runfiles import COMPRESSIONS, DIGEST_FILE, DIGEST_IDS_VERSION, compress_output, digest_entry
+import runindex
+from throttle import Throttle, configure_retries, is_throttle, service_for, backoff, MAX_REQUEUES
+from workqueue import WorkQueue, LeaseRenewer, QUEUE_FILE, POLL_INTERVAL, UNKNOWN_COST, worker_id
+from durations import load_history, unit_cost, save_history, record as record_duration, longest_first, unit_timeout
+from common import load_state, save_state, get_region, utc_iso, POLICIES_DIR, OUTPUTS_DIR
+
+POLICY_TIMEOUT = 120  # seconds per custodian invocation until its policies have a duration history
+TAIL_LINES = 50  # child output lines kept in memory for the manifest's stderr
+
+# custodian's log format: "2024-01-01 00:00:00,000: custodian.policy:INFO policy:x resource:y ..."
+LOG_LINE = re.compile(r"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d+: (?P<logger>[\w.]+):(?P<level>[A-Z]+) (?P<message>.*)$")
+POLICY_FIELD = re.compile(r"\bpolicy:(\S+)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of custodian invocations to run concurrently (default: 1, serial)")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="policies merged into each custodian invocation (default: 1, 0 = all in one)")
+    parser.add_argument("--engine", choices=["cli", "api", "local"], default="cli",
+                        help="cli: one custodian subprocess per invocation; api: run in-process via c7n's Python API; "
+                             "local: evaluate value-filter policies over --snapshot (others run as cli)")
+    parser.add_argument("--snapshot", metavar="DIR",
+                        help="inventory snapshot for --engine local, one <resource>.json list per type "
+                             "(as written by --save-snapshot)")
+    parser.add_argument("--save-snapshot", metavar="DIR",
+                        help="with --engine api, save each resource type's described inventory to DIR")
+    parser.add_argument("--group-by-resource", action="store_true",
+                        help="run all policies on a resource type in one invocation so its inventory is "
+                             "described once (always on for --engine api)")
+    parser.add_argument("--regions",
+                        help="comma-separated regions to run in, or 'all' for every enabled region "
+                             "(default: the state/env region; outputs go to <run>/<region>/<policy>/)")
+    parser.add_argument("--region-workers", type=int, default=4,
+                        help="regions run concurrently (default: 4); --workers applies within each region")
+    parser.add_argument("--accounts",
+                        help="accounts file (account_id + role per entry) to run every account in parallel; "
+                             "outputs go to <run>/<account>/<region>/<policy>/")
+    parser.add_argument("--account-workers", type=int, default=4,
+                        help="accounts run concurrently (default: 4)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="reuse a policy's previous outputs when its definition and its resource type's "
+                             "inventory fingerprint are unchanged and the result is younger than --max-age")
+    parser.add_argument("--max-age", type=int, default=60,
+                        help="freshness window in minutes for --incremental reuse (default: 60)")
+    parser.add_argument("--reuse-unfingerprinted", action="store_true",
+                        help="with --incremental, also reuse policies on resource types that have no inventory "
+                             "fingerprint (anything but s3, ec2 and ebs) on their hash and --max-age alone")
+    parser.add_argument("--record", metavar="DIR",
+                        help="save every AWS API response to DIR with placebo (implies --engine api)")
+    parser.add_argument("--force", action="store_true",
+                        help="with --record, replace a recording already in DIR")
+    parser.add_argument("--replay", metavar="DIR",
+                        help="run against the responses recorded in DIR, without credentials or network "
+                             "(implies --engine api)")
+    parser.add_argument("--rate-limit", type=float,
+                        help="per-service ceiling shared by all workers, halved on throttling and recovered "
+                             "gradually: API calls/s in-process, invocations started/s for the CLI engine "
+                             "(default: unlimited)")
+    parser.add_argument("--policies",
+                        help="comma-separated policy names to run (default: every policy in policies/)")
+    parser.add_argument("--resume", metavar="RUN_ID",
+                        help="continue an interrupted or partly failed run in place, executing only the "
+                             "policies its manifest has no ok result for")
+    parser.add_argument("--compress", choices=sorted(COMPRESSIONS),
+                        help="compress each policy's resources.json once it is written "
+                             "(zstd needs the zstandard package)")
+    parser.add_argument("--queue", action="store_true",
+                        help="coordinate the run through a work queue in its run directory, so runners "
+                             "started with --join can share its units")
+    parser.add_argument("--join", metavar="RUN_ID",
+                        help="work on the queued units of a --queue run until none are left to claim")
+    args = parser.parse_args()
+    if args.record and args.replay:
+        parser.error("--record and --replay are mutually exclusive")
+    if args.force and not args.record:
+        parser.error("--force only applies to --record")
+    if args.record and recording.has_recording(args.record) and not args.force:
+        parser.error(f"--record: {args.record} already holds a recording, whose responses a replay would "
+                     "serve before the new ones; pass --force to replace it")
+    if args.engine == "local" and not args.snapshot:
+        parser.error("--engine local needs --snapshot DIR")
+    if args.save_snapshot and args.engine != "api":
+        parser.error("--save-snapshot needs --engine api")
+    if args.reuse_unfingerprinted and not args.incremental:
+        parser.error("--reuse-unfingerprinted only applies to --incremental")
+    if args.replay and args.incremental:
+        parser.error("--incremental needs live inventory fingerprints and cannot be replayed")
+    if args.queue and (args.record or args.replay):
+        parser.error("--record and --replay need calls in a fixed order and cannot be queued")
+    if args.compress == "zstd":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            parser.error("--compress zstd needs the zstandard package (pip install zstandard)")
+    if args.join and (args.queue or args.resume):
+        parser.error("--join takes its run and options from the coordinator")
+    return args
+
+
+def load_policies(policy_files):
+    """Read every policy in the given YAML files (custodian uses the names for output dirs)."""
+    policies = []
+    for pf in policy_files:
+        with open(pf) as f:
+            pdata = yaml.safe_load(f)
+        for policy in pdata["policies"]:
+            rtype = policy.get("resource", "")
+            if rtype.startswith("aws."):
+                rtype = rtype.split(".", 1)[1]
+            policies.append({
+                "policy_file": pf,
+                "file_policies": len(pdata["policies"]),
+                "name": policy["name"],
+                "resource": rtype,
+                "data": policy,
+            })
+    return policies
+
+
+def make_units(policies, batch_size=1, batch_dir=None, group_by_resource=False):
+    """Group policies into custodian invocations.
+
+    Without batching each policy file is its own invocation. With batching,
+    policies are merged into combined documents of ``batch_size`` policies so
+    interpreter start, c7n import and session setup are paid once per batch.
+    Grouping by resource puts every policy on one resource type into the same
+    invocation (split further only when ``batch_size`` > 1), so the type's
+    inventory is described once and shared through the resource cache.
+    Combined documents are written to ``batch_dir`` when one is given.
+    """
+    units, chunks = [], []
+    if group_by_resource:
+        groups = {}
+        for p in policies:
+            groups.setdefault(p["resource"], []).append(p)
+        for rtype, group in groups.items():
+            size = batch_size if batch_size > 1 else len(group)
+            for i in range(0, len(group), size):
+                unit_id = rtype if size >= len(group) else f"{rtype}-{i // size + 1:03d}"
+                chunks.append((unit_id, group[i:i + size]))
+    elif batch_size == 1:
+        files = {}
+        for p in policies:
+            files.setdefault(p["policy_file"], []).append(p)
+        for pf, ps in files.items():
+            unit_id = os.path.splitext(os.path.basename(pf))[0]
+            if len(ps) == ps[0]["file_policies"] or not batch_dir:
+                units.append({"id": unit_id, "policy_file": pf, "policies": ps})
+            else:
+                # Only part of the file is due (e.g. the rest was reused), so
+                # run just those policies from a document of their own.
+                chunks.append((unit_id, ps))
+    else:
+        size = batch_size if batch_size > 0 else len(policies)
+        chunks = [(f"batch-{n + 1:03d}", policies[i:i + size]) for n, i in enumerate(range(0, len(policies), size))]
+
+    for unit_id, chunk in chunks:
+        policy_file = None
+        if batch_dir:
+            os.makedirs(batch_dir, exist_ok=True)
+            policy_file = os.path.join(batch_dir, f"{unit_id}.yml")
+            with open(policy_file, "w") as f:
+                yaml.dump({"policies": [p["data"] for p in chunk]}, f, default_flow_style=False, sort_keys=False)
+        units.append({"id": unit_id, "policy_file": policy_file, "policies": chunk})
+    return units
+
+
+def custodian_bin():
+    """Find custodian executable in the same venv as this script."""
+    return os.path.join(os.path.dirname(sys.executable), "custodian")
+
+
+def read_policy_metadata(run_output_dir, pname):
+    """Return the metadata.json custodian wrote for a policy, or None."""
+    path = os.path.join(run_output_dir, pname, "metadata.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def policy_failed(metadata):
+    """Custodian records a PolicyException metric when a policy raises."""
+    if metadata is None:
+        return True
+    return any(m.get("MetricName") == "PolicyException" for m in metadata.get("metrics", []))
+
+
+def policy_result(p, returncode, start, end):
+    """Build the manifest entry for one policy."""
+    return {
+        "policy_file": p["policy_file"],
+        "name": p["name"],
+        "resource": p["resource"],
+        "status": "ok" if returncode == 0 else "error",
+        "returncode": returncode,
+        "start": utc_iso(start),
+        "end": utc_iso(end),
+        "duration": round(end - start, 3),
+    }
+
+
+class EventLog:
+    """Append-only JSON lines log shared by every worker of a run."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+
+    def write(self, event, **fields):
+        line = json.dumps({"time": round(time.time(), 3), "event": event, **fields}, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def parse_log_line(line):
+    """Split a custodian log line into level, logger, policy and message fields."""
+    m = LOG_LINE.match(line)
+    if not m:
+        return {"level": None, "message": line}
+    fields = m.groupdict()
+    policy = POLICY_FIELD.search(fields["message"])
+    if policy:
+        fields["policy"] = policy.group(1)
+    return fields
+
+
+class CliEngine:
+    """Run each unit as a ``custodian run`` subprocess.
+
+    Child output is streamed line by line into ``log_dir/<unit>.log`` and the
+    run's event log instead of being buffered; only the last TAIL_LINES lines
+    are kept in memory. Warnings, errors and throttling show up live.
+    """
+
+    name = "cli"
+
+    def __init__(self, run_output_dir, region, account_id, private_cache=False, credentials=None,
+                 log_dir=None, events=None, throttle=None):
+        self.run_output_dir = run_output_dir
+        self.region = region
+        self.account_id = account_id
+        self.credentials = credentials
+        self.log_dir = log_dir
+        self.events = events
+        self.throttle = throttle or Throttle()
+        # Concurrent custodian processes race on the shared sqlite resource
+        # cache (~/.cache/cloud-custodian.cache), so parallel runs give each
+        # invocation its own cache file; policies within one invocation still
+        # share described resources through it.
+        self.cache_dir = tempfile.mkdtemp(prefix="c7n-cache-") if private_cache else None
+
+    def close(self):
+        if self.cache_dir:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def run_unit(self, unit):
+        """Run one custodian invocation and return a manifest entry per policy in it."""
+        cmd = [
+            custodian_bin(),
+            "run", "-s", self.run_output_dir, unit["policy_file"],
+            "--region", self.region,
+        ]
+        if self.cache_dir:
+            cmd += ["--cache", os.path.join(self.cache_dir, f"{unit['id']}.cache")]
+
+        timeout = unit.get("timeout", POLICY_TIMEOUT)
+        # Batches may mix types; the first policy's service stands for the unit.
+        service = service_for(unit["policies"][0]["resource"])
+        self.throttle.acquire(service)
+        start = time.time()
+        env = self.credentials.env() if self.credentials else os.environ.copy()
+        returncode, tail, throttled = self.stream(cmd, env, unit["id"], timeout)
+        self.throttle.feedback(service, throttled > 0)
+        if throttled:
+            self.throttle.record(service, throttled)
+        stderr = "\n".join(tail)
+        if returncode is None:
+            stderr = f"timed out after {timeout}s\n{stderr}"
+        end = time.time()
+
+        batched = len(unit["policies"]) > 1
+        results = []
+        for p in unit["policies"]:
+            p_start, p_end, p_rc = start, end, returncode
+            if batched:
+                # custodian exits non-zero if any policy in the document failed, so
+                # per-policy outcome and timing come from each policy's metadata.json.
+                metadata = read_policy_metadata(self.run_output_dir, p["name"])
+                p_rc = 1 if policy_failed(metadata) else 0
+                if returncode is None:
+                    p_rc = None
+                if metadata:
+                    p_start = metadata["execution"]["start"]
+                    p_end = metadata["execution"].get("end_time", p_end)
+
+            result = policy_result(p, p_rc, p_start, p_end)
+            if unit["policy_file"] != p["policy_file"]:
+                result["batch_file"] = unit["policy_file"]
+            if p_rc != 0:
+                result["stderr"] = stderr[-500:]
+            if throttled:
+                result["throttled"] = throttled
+            results.append(result)
+        return results
+
+    def stream(self, cmd, env, unit_id, timeout):
+        """Run ``cmd``, streaming its output.
+
+        Returns the return code (None on timeout), the last lines and the
+        number of throttling lines seen.
+        """
+        where = {"unit": unit_id, "account_id": self.account_id, "region": self.region}
+        tail = deque(maxlen=TAIL_LINES)
+        throttles = 0
+        log = None
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+            log = open(os.path.join(self.log_dir, f"{unit_id}.log"), "w")
+        if self.events:
+            self.events.write("unit_start", **where)
+
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env)
+        killed = threading.Event()
+
+        def kill():
+            killed.set()
+            proc.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            for line in proc.stdout:
+                line = line.rstrip("\n")
+                tail.append(line)
+                if log:
+                    log.write(line + "\n")
+                fields = parse_log_line(line)
+                throttled = is_throttle(line)
+                throttles += throttled
+                if self.events:
+                    self.events.write("throttle" if throttled else "log", **where, **fields)
+                if throttled or fields["level"] in ("WARNING", "ERROR", "CRITICAL"):
+                    print(f"  [{self.region} {unit_id}] {line}")
+            proc.wait()
+        finally:
+            timer.cancel()
+            if log:
+                log.close()
+        returncode = None if killed.is_set() else proc.returncode
+        if self.events:
+            self.events.write("unit_end", **where, returncode=returncode)
+        return returncode, tail, throttles
+
+
+class SnapshotCache:
+    """Resource cache shared by the in-process engine's policies.
+
+    Implements the cache interface c7n's resource managers use. The first
+    policy on a resource type describes the inventory and saves it here; later
+    policies on the same type and region load it instead of describing again.
+    Entries are stored pickled so every policy gets its own copy, since
+    filters annotate resources in place (c7n's InMemoryCache hands out the
+    same dicts to every policy).
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def load(self):
+        return True
+
+    def get(self, key):
+        blob = self.data.get(json.dumps(key, sort_keys=True, default=str))
+        return pickle.loads(blob) if blob is not None else None
+
+    def save(self, key, data):
+        self.data[json.dumps(key, sort_keys=True, default=str)] = pickle.dumps(data)
+
+    def size(self):
+        return sum(len(blob) for blob in self.data.values())
+
+    def inventory(self):
+        """The first inventory saved, or None."""
+        for blob in self.data.values():
+            return pickle.loads(blob)
+        return None
+
+    def clear(self):
+        self.data.clear()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class ApiEngine:
+    """Run units inside this process through c7n's Python API.
+
+    The resource registry and session factory are loaded once and shared by
+    every policy, so there is no interpreter start-up or child output
+    buffering per policy. Units are expected to be grouped by resource type:
+    a unit's policies share one inventory snapshot, which is dropped when the
+    unit finishes. c7n captures each policy's log into its output directory
+    through process-global logging, so units run one at a time.
+    """
+
+    name = "api"
+
+    def __init__(self, run_output_dir, region, account_id, credentials=None, session_factory=None,
+                 snapshot_dir=None, throttle=None):
+        from c7n.config import Config
+        from c7n.credentials import SessionFactory
+        from c7n.loader import PolicyLoader
+        from c7n.provider import clouds
+
+        self.run_output_dir = run_output_dir
+        self.region = region
+        self.account_id = account_id
+        self.provider = clouds["aws"]()
+        self.options = self.provider.initialize(Config.empty(
+            region=region,
+            regions=[region],
+            account_id=account_id,
+            output_dir=run_output_dir,
+            cache="memory",
+            cache_period=15,
+        ))
+        self.loader = PolicyLoader(self.options)
+        if session_factory:
+            self.session_factory = session_factory
+        elif credentials:
+            self.session_factory = credentials.c7n_session_factory(region)
+        else:
+            self.session_factory = SessionFactory(region)
+        # Every API call takes a token from its service's bucket, and
+        # throttled attempts are counted against the running policy.
+        self.throttled = 0
+        (throttle or Throttle()).attach(self.session_factory, self._count_throttle)
+        self.snapshots = SnapshotCache()
+        self.snapshot_dir = snapshot_dir
+        # Match the CLI so each policy's custodian-run.log gets its INFO lines.
+        logging.getLogger("custodian").setLevel(logging.INFO)
+
+    def close(self):
+        self.snapshots.clear()
+
+    def _count_throttle(self, service):
+        self.throttled += 1
+
+    def run_unit(self, unit):
+        """Load and run the unit's policies, returning a manifest entry per policy."""
+        from c7n.policy import Policy
+
+        data = {"policies": [p["data"] for p in unit["policies"]]}
+        try:
+            collection = self.loader.load_data(data, unit["policy_file"] or unit["id"],
+                                               session_factory=self.session_factory)
+            # initialize_policies re-creates each policy with a default session
+            # factory, so rebuild them around ours (assumed role, recording).
+            loaded = {p.name: Policy(p.data, p.options, session_factory=self.session_factory)
+                      for p in self.provider.initialize_policies(collection, self.options)}
+        except Exception as e:
+            now = time.time()
+            return [dict(policy_result(p, 1, now, now), error=str(e)[:500]) for p in unit["policies"]]
+
+        for policy in loaded.values():
+            policy.resource_manager._cache = self.snapshots
+
+        results = []
+        for p in unit["policies"]:
+            start = time.time()
+            error = None
+            self.throttled = 0
+            try:
+                loaded[p["name"]]()
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            end = time.time()
+            result = policy_result(p, 0 if error is None else 1, start, end)
+            if error:
+                result["error"] = error[:500]
+            if self.throttled:
+                result["throttled"] = self.throttled
+            results.append(result)
+        if self.snapshot_dir and not any("query" in p["data"] for p in unit["policies"]):
+            # Without custom queries the unit's one cache entry is the type's full inventory.
+            self.save_inventory(unit["policies"][0]["resource"])
+        self.snapshots.clear()
+        return results
+
+    def save_inventory(self, rtype):
+        """Write the unit's described inventory where --engine local reads it."""
+        from c7n.utils import dumps
+
+        resources = self.snapshots.inventory()
+        if resources is None:
+            return
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        # Serialised like resources.json, so values compare the same way.
+        with open(os.path.join(self.snapshot_dir, f"{rtype}.json"), "w") as f:
+            dumps(resources, f, indent=2)
+
+
+class LocalEngine:
+    """Evaluate value-filter policies over an inventory snapshot, with no AWS calls.
+
+    Units marked ``local`` hold every such policy on one resource type, so its
+    snapshot is read once and all of them are evaluated in a single pass
+    (see evaluator.py). Other units are handed to the CLI engine.
+    """
+
+    name = "local"
+
+    def __init__(self, run_output_dir, region, account_id, snapshot_dir, fallback):
+        self.run_output_dir = run_output_dir
+        self.region = region
+        self.account_id = account_id
+        self.snapshot_dir = snapshot_dir
+        self.fallback = fallback
+
+    def close(self):
+        self.fallback.close()
+
+    def run_unit(self, unit):
+        if not unit.get("local"):
+            return self.fallback.run_unit(unit)
+        path = os.path.join(self.snapshot_dir, f"{unit['policies'][0]['resource']}.json")
+        start = time.time()
+        try:
+            matched = evaluator.evaluate([p["data"] for p in unit["policies"]], evaluator.load_snapshot(path))
+        except (OSError, ValueError) as e:
+            now = time.time()
+            return [dict(policy_result(p, 1, now, now), error=f"{type(e).__name__}: {e}"[:500])
+                    for p in unit["policies"]]
+        end = time.time()
+
+        results = []
+        for p in unit["policies"]:
+            evaluator.write_outputs(os.path.join(self.run_output_dir, p["name"]), p["data"], matched[p["name"]],
+                                    start, end, self.region, self.account_id, path)
+            results.append(dict(policy_result(p, 0, start, end), snapshot=path))
+        return results
+
+
+def report(results):
+    """Print a one-line outcome for each policy of a finished invocation."""
+    for result in results:
+        label = result.get("output_path", result["name"])
+        if "reused_from" in result:
+            print(f"  {label:50s} REUSED (from {result['reused_from']})")
+        elif result["status"] == "ok":
+            print(f"  {label:50s} OK     ({result['duration']:.1f}s)")
+        else:
+            print(f"  {label:50s} ERROR  (rc={result['returncode']})")
+            if result.get("stderr"):
+                print(f"    stderr: {result['stderr']}")
+            if result.get("error"):
+                print(f"    error: {result['error']}")
+
+
+def resolve_regions(args, default_region):
+    """Return the regions to run in: --regions as a list, 'all' enabled regions, or the default."""
+    if not args.regions:
+        return [default_region]
+    if args.regions == "all":
+        ec2 = boto3.client("ec2", region_name=default_region)
+        resp = ec2.describe_regions(Filters=[{"Name": "opt-in-status", "Values": ["opt-in-not-required", "opted-in"]}])
+        return sorted(r["RegionName"] for r in resp["Regions"])
+    return [r.strip() for r in args.regions.split(",") if r.strip()]
+
+
+def resume_scope(args, manifest, default_region):
+    """Accounts, regions and output layout of the run a --resume continues, as its manifest recorded them.
+
+    Raises ValueError when --accounts, --regions, --policies or --compress ask
+    for something else: resuming with another scope would drop results.
+    """
+    run_id = manifest["run_id"]
+    regions = manifest.get("regions") or manifest["region"].split(",")
+    account_ids = [a["account_id"] for a in manifest.get("accounts", [])] or manifest["account_id"].split(",")
+    names = {a["account_id"]: a["name"] for a in manifest.get("accounts", [])}
+    policies = manifest.get("policies_run", [])
+    if "per_account" in manifest:
+        per_account, per_region = manifest["per_account"], manifest["per_region"]
+    else:
+        # Older manifests: outputs live at [<account>/][<region>/]<policy>.
+        depths = {len(r["output_path"].split(os.sep)) for r in manifest.get("results", []) if "output_path" in r}
+        per_account = 3 in depths or len(account_ids) > 1
+        per_region = per_account or 2 in depths or len(regions) > 1
+
+    if args.regions and set(resolve_regions(args, default_region)) != set(regions):
+        raise ValueError(f"{run_id} ran in {', '.join(regions)}; leave out --regions to resume it")
+    if args.policies and set(args.policies.split(",")) != set(policies):
+        raise ValueError(f"{run_id} ran {', '.join(policies)}; leave out --policies to resume it")
+    if args.compress and args.compress != manifest.get("compress"):
+        raise ValueError(f"{run_id} was run with --compress {manifest.get('compress')}; "
+                         "leave out --compress to resume it")
+    if args.accounts:
+        listed = {a["account_id"]: a for a in load_accounts(args.accounts)}
+        if set(listed) != set(account_ids):
+            raise ValueError(f"{args.accounts} does not list the accounts of {run_id}: {', '.join(account_ids)}")
+        accounts = attach_credentials([listed[a] for a in account_ids], default_region)
+    elif per_account:
+        raise ValueError(f"{run_id} ran over --accounts; pass the same accounts file to resume it")
+    else:
+        if not args.replay:
+            caller = boto3.client("sts", region_name=default_region).get_caller_identity()["Account"]
+            if caller != account_ids[0]:
+                raise ValueError(f"{run_id} ran in account {account_ids[0]}, these credentials are for {caller}")
+        accounts = [{"account_id": account_ids[0], "name": names.get(account_ids[0], account_ids[0]),
+                     "credentials": None}]
+    args.policies = ",".join(policies)
+    args.compress = manifest.get("compress")
+    return accounts, regions, per_account, per_region
+
+
+def tag_results(results, engine, run_output_dir):
+    """Record where each result ran and where its outputs live relative to the run directory."""
+    for r in results:
+        r["account_id"] = engine.account_id
+        r["region"] = engine.region
+        r["output_path"] = os.path.relpath(os.path.join(engine.run_output_dir, r["name"]), run_output_dir)
+    return results
+
+
+def write_manifest(path, manifest):
+    """Write the manifest atomically, so a reader or a crash never sees half of it."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def throttled_failure(results):
+    """Whether a unit failed because AWS throttled it."""
+    return any(r["status"] != "ok" and (r.get("throttled") or is_throttle(r.get("stderr", "") + r.get("error", "")))
+               for r in results)
+
+
+def finish_outputs(results, run_output_dir, compress=None):
+    """Digest each result's outputs while they are fresh, then compress its resources.json if asked.
+
+    The digest travels with the result (through the work queue too) until
+    the run's digest.json is written; metadata.json stays plain for the
+    runner's own reads.
+    """
+    for r in results:
+        policy_dir = os.path.join(run_output_dir, r["output_path"])
+        r["digest"] = digest_entry(policy_dir, r["resource"])
+        path = os.path.join(policy_dir, "resources.json")
+        if compress and os.path.exists(path):
+            compress_output(path, compress)
+
+
+def write_digest(run_output_dir, run_id, results):
+    """Write digest.json: per-policy counts, resource ids, durations and API stats for instant summaries.
+
+    Results without a digest (kept on --resume, reused, or from an older
+    runner) are digested from their files here.
+    """
+    policies = {}
+    for r in results:
+        entry = r.get("digest") or digest_entry(os.path.join(run_output_dir, r["output_path"]), r["resource"])
+        policies[r["output_path"]] = {"name": r["name"], "account_id": r["account_id"], "region": r["region"],
+                                      "status": r["status"], **entry}
+    path = os.path.join(run_output_dir, DIGEST_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"run_id": run_id, "generated_at": utc_iso(), "ids_version": DIGEST_IDS_VERSION,
+                   "policies": policies}, f)
+    os.replace(tmp, path)
+
+
+def execute(engine, unit, run_output_dir, throttle=None, compress=None):
+    """Run one unit, retrying it after a jittered backoff while it fails through throttling."""
+    for attempt in range(MAX_REQUEUES + 1):
+        results = tag_results(engine.run_unit(unit), engine, run_output_dir)
+        if attempt == MAX_REQUEUES or not throttled_failure(results):
+            break
+        delay = backoff(attempt)
+        if throttle:
+            throttle.record_requeue(service_for(unit["policies"][0]["resource"]))
+        print(f"  [{engine.region} {unit['id']}] throttled, retrying in {delay:.0f}s")
+        time.sleep(delay)
+    if attempt:
+        for r in results:
+            r["attempts"] = attempt + 1
+    finish_outputs(results, run_output_dir, compress)
+    report(results)
+    return results
+
+
+def run_region(engine, units, workers, run_output_dir, on_done=None, throttle=None, compress=None):
+    """Run every unit against one region's engine, at most ``workers`` at a time.
+
+    Each call gets a fresh pool, so c7n's thread-local session cache (keyed
+    by region only) is never shared between accounts. A unit that fails
+    through throttling is retried up to MAX_REQUEUES times (see execute).
+    ``on_done`` is called with each unit's results as soon as it finishes.
+    """
+    def run(unit):
+        results = execute(engine, unit, run_output_dir, throttle, compress)
+        if on_done:
+            on_done(results)
+        return results
+
+    # Each custodian run is network-bound, so threads waiting on subprocesses
+    # are enough to overlap them.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run, unit) for unit in units]
+        results = [r for f in futures for r in f.result()]
+    engine.close()
+    return results
+
+
+def attach_credentials(accounts, region):
+    for account in accounts:
+        account["credentials"] = (RoleCredentials(account["role"], account["external_id"], region)
+                                  if account.get("role") else None)
+    return accounts
 
 
 def main():
+    args = parse_args()
     state = load_state()
-    region = state.get("region", get_region())
+    default_region = state.get("region", get_region())
+    per_account = bool(args.accounts)
+    per_region = bool(args.accounts or args.regions)
 
-    # Resolve account id
-    sts = boto3.client("sts", region_name=region)
-    account_id = sts.get_caller_identity()["Account"]
+    worker = worker_id()
+    queue = None
+    resumed = None
+    if args.resume:
+        manifest_path = os.path.join(OUTPUTS_DIR, args.resume, "manifest.json")
+        if not os.path.exists(manifest_path):
+            print(f"ERROR: Nothing to resume, no manifest at {manifest_path}")
+            sys.exit(1)
+        with open(manifest_path) as f:
+            resumed = json.load(f)
 
-    run_id = f"run-{int(time.time())}"
-    run_output_dir = os.path.join(OUTPUTS_DIR, run_id)
-    os.makedirs(run_output_dir, exist_ok=True)
+    if args.join:
+        # Accounts, regions, policies and engine come from the coordinator.
+        try:
+            queue = WorkQueue.open(os.path.join(OUTPUTS_DIR, args.join, QUEUE_FILE))
+        except FileNotFoundError as e:
+            print(f"ERROR: Cannot join {args.join}: {e}")
+            sys.exit(1)
+        spec = queue.spec()
+        accounts = attach_credentials(spec["accounts"], default_region)
+        regions = spec["regions"]
+        per_account, per_region = spec["per_account"], spec["per_region"]
+        args.engine, args.snapshot, args.save_snapshot = spec["engine"], spec["snapshot"], spec["save_snapshot"]
+        args.policies = ",".join(spec["policies"])
+        args.compress = spec["compress"]
+    elif args.resume:
+        # Accounts, regions, policies and output layout come from the run being resumed.
+        try:
+            accounts, regions, per_account, per_region = resume_scope(args, resumed, default_region)
+        except ValueError as e:
+            print(f"ERROR: Cannot resume: {e}")
+            sys.exit(1)
+    elif args.replay:
+        # Accounts, regions and output layout come from the recording.
+        index = recording.read_index(args.replay)
+        accounts = [dict(a, credentials=None) for a in index["accounts"]]
+        regions = [r.strip() for r in args.regions.split(",")] if args.regions else index["regions"]
+        per_account, per_region = index["per_account"], index["per_region"] or len(regions) > 1
+    elif args.accounts:
+        accounts = load_accounts(args.accounts)
+        if not accounts:
+            print(f"ERROR: No accounts listed in {args.accounts}.")
+            sys.exit(1)
+        attach_credentials(accounts, default_region)
+    else:
+        # Resolve account id
+        sts = boto3.client("sts", region_name=default_region)
+        account_id = sts.get_caller_identity()["Account"]
+        accounts = [{"account_id": account_id, "name": account_id, "credentials": None}]
+    if not (args.replay or args.join or args.resume):
+        regions = resolve_regions(args, default_region)
+    if args.record or args.replay:
+        # placebo hooks the in-process session, and needs c7n's calls in a fixed order.
+        args.engine = "api"
+        recording.serialize_c7n()
+    if args.record:
+        recording.clear(args.record)
+        recording.write_index(args.record, accounts, regions, per_account, per_region)
+
+    previous = {}
+    if args.join:
+        run_id = args.join
+        run_output_dir = os.path.join(OUTPUTS_DIR, run_id)
+    elif args.resume:
+        run_id = args.resume
+        run_output_dir = os.path.join(OUTPUTS_DIR, run_id)
+        previous = {(r["account_id"], r["region"], r["name"]): r
+                    for r in resumed.get("results", []) if "output_path" in r}
+    else:
+        run_id = f"run-{int(time.time())}"
+        run_output_dir = os.path.join(OUTPUTS_DIR, run_id)
+        os.makedirs(run_output_dir, exist_ok=True)
+    manifest_path = os.path.join(run_output_dir, "manifest.json")
+    # Joined workers keep their own event log; appends from several hosts to
+    # one file on shared storage can interleave.
+    events = EventLog(os.path.join(run_output_dir, f"events-{worker}.jsonl" if args.join else "events.jsonl"))
+    throttle = Throttle(args.rate_limit)
+    configure_retries()
 
     policy_files = sorted(glob.glob(os.path.join(POLICIES_DIR, "*.yml")))
     if not policy_files:
         print("ERROR: No policy YAML files found in policies/. Run 02_generate_policies.py first.")
         sys.exit(1)
 
-    print(f"Run ID:     {run_id}")
-    print(f"Account:    {account_id}")
-    print(f"Region:     {region}")
-    print(f"Policies:   {len(policy_files)}")
-    print(f"Output dir: {run_output_dir}")
-    print()
+    workers = max(1, args.workers)
+    region_workers = min(max(1, args.region_workers), len(regions))
+    account_workers = min(max(1, args.account_workers), len(accounts))
+    policies = load_policies(policy_files)
+    if args.policies:
+        wanted = args.policies.split(",")
+        unknown = sorted(set(wanted) - {p["name"] for p in policies})
+        if unknown:
+            print(f"ERROR: Unknown policies: {', '.join(unknown)}")
+            sys.exit(1)
+        policies = [p for p in policies if p["name"] in wanted]
+    policies_by_name = {p["name"]: p for p in policies}
+    if args.engine == "api":
+        # c7n's per-policy log capture is process-global, so nothing runs alongside.
+        workers = region_workers = account_workers = 1
+    concurrent = (workers > 1 and len(policies) > 1) or region_workers > 1 or account_workers > 1
 
-    results = []
+    # On --resume, ok results stand; everything else is executed again.
+    kept = [r for r in previous.values() if r["status"] == "ok"]
+    done = {(r["account_id"], r["region"], r["name"]) for r in kept}
 
-    for pf in policy_files:
-        # Read the actual policy name from the YAML (custodian uses this for output dirs)
-        import yaml
-        with open(pf) as _f:
-            pdata = yaml.safe_load(_f)
-        pname = pdata["policies"][0]["name"]
-        print(f"Running policy: {pname} ... ", end="", flush=True)
+    if args.queue:
+        queue = WorkQueue.create(os.path.join(run_output_dir, QUEUE_FILE), {
+            "accounts": [{k: a.get(k) for k in ("account_id", "name", "role", "external_id")} for a in accounts],
+            "regions": regions,
+            "per_account": per_account,
+            "per_region": per_region,
+            "engine": args.engine,
+            "snapshot": args.snapshot and os.path.abspath(args.snapshot),
+            "save_snapshot": args.save_snapshot and os.path.abspath(args.save_snapshot),
+            "compress": args.compress,
+            "policies": [p["name"] for p in policies],
+        })
 
-        # Find custodian executable in the same venv as this script
-        venv_bin = os.path.dirname(sys.executable)
-        custodian_bin = os.path.join(venv_bin, "custodian")
+    run_started = time.time()
+    reuse_store = load_reuse_store() if args.incremental else {}
+    history = load_history()
+    target_fingerprints = {}
 
-        cmd = [
-            custodian_bin,
-            "run", "-s", run_output_dir, pf,
-            "--region", region,
-        ]
+    def target_dir(account, region):
+        # Outputs are laid out as <run>/[<account>/][<region>/]<policy>/ with
+        # the account level for --accounts runs and the region level whenever
+        # --regions or --accounts is given.
+        path = run_output_dir
+        if per_account:
+            path = os.path.join(path, account["account_id"])
+        if per_region:
+            path = os.path.join(path, region)
+        return path
 
-        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=120, env=os.environ.copy())
+    def make_engine(account, region):
+        if args.engine == "api":
+            session_factory = None
+            mode, root = ("record", args.record) if args.record else ("replay", args.replay)
+            if root:
+                session_factory = recording.session_factory(
+                    mode, recording.target_dir(root, account["account_id"], region), region, account["credentials"])
+            save_dir = args.save_snapshot and os.path.join(args.save_snapshot, target_rel(account, region))
+            return ApiEngine(target_dir(account, region), region, account["account_id"], account["credentials"],
+                             session_factory, os.path.normpath(save_dir) if save_dir else None, throttle)
+        log_dir = os.path.normpath(os.path.join(run_output_dir, "logs", target_rel(account, region)))
+        engine = CliEngine(target_dir(account, region), region, account["account_id"], concurrent,
+                           account["credentials"], log_dir, events, throttle)
+        if args.engine == "local":
+            snapshot_dir = os.path.normpath(os.path.join(args.snapshot, target_rel(account, region)))
+            return LocalEngine(engine.run_output_dir, region, account["account_id"], snapshot_dir, engine)
+        return engine
 
-        if proc.returncode != 0:
-            print(f"ERROR (rc={proc.returncode})")
-            if proc.stderr:
-                print(f"  stderr: {proc.stderr[:500]}")
-            results.append({"policy_file": pf, "name": pname, "status": "error", "returncode": proc.returncode})
-        else:
-            print("OK")
-            results.append({"policy_file": pf, "name": pname, "status": "ok", "returncode": 0})
-
-    # Write manifest
-    manifest = {
-        "run_id": run_id,
-        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
-        "account_id": account_id,
-        "region": region,
-        "policies_run": [r["name"] for r in results],
-        "output_dir": run_output_dir,
-        "results": results,
-    }
+    def target_rel(account, region):
+        # Snapshots mirror the run layout: <dir>/[<account>/][<region>/]<resource>.json.
+        return os.path.relpath(target_dir(account, region), run_output_dir)
 
-    manifest_path = os.path.join(run_output_dir, "manifest.json")
-    with open(manifest_path, "w") as f:
-        json.dump(manifest, f, indent=2)
+    def make_target_units(engine, pending):
+        if args.engine == "local":
+            # Every value-filter policy on a type is evaluated in one pass over its snapshot.
+            local = [p for p in pending if evaluator.supported(p["data"])]
+            units = make_units(local, group_by_resource=True)
+            for unit in units:
+                unit["local"] = True
+            pending = [p for p in pending if not evaluator.supported(p["data"])]
+            return units + make_cli_units(engine, pending)
+        if args.engine == "api":
+            # In-process runs have no per-invocation start-up cost to amortise;
+            # units only mark which policies share an inventory snapshot.
+            return make_units(pending, group_by_resource=True)
+        return make_cli_units(engine, pending)
+
+    def make_cli_units(engine, pending):
+        batch_dir = os.path.join(run_output_dir, "batches", os.path.relpath(engine.run_output_dir, run_output_dir))
+        return make_units(pending, args.batch_size, os.path.normpath(batch_dir),
+                          group_by_resource=args.group_by_resource)
+
+    def reuse_previous(account, engine, candidates):
+        """Split policies into those to execute and results reused from earlier runs."""
+        session = (account["credentials"].session(engine.region) if account["credentials"]
+                   else boto3.Session(region_name=engine.region))
+        fingerprints = inventory_fingerprints(session, [p["resource"] for p in candidates])
+        target_fingerprints[(account["account_id"], engine.region)] = fingerprints
+
+        pending, reused = [], []
+        for p in candidates:
+            record = reuse_store.get(store_key(account["account_id"], engine.region, p["name"]))
+            if not reusable(record, p, fingerprints, args.max_age * 60, args.reuse_unfingerprinted):
+                pending.append(p)
+                continue
+            reuse_outputs(record, os.path.join(engine.run_output_dir, p["name"]))
+            now = time.time()
+            result = policy_result(p, 0, now, now)
+            result["reused_from"] = record["run_id"]
+            reused.append(result)
+        report(tag_results(reused, engine, run_output_dir))
+        return pending, reused
+
+    completed = []
+    checkpoint_lock = threading.Lock()
+    accounts_by_id = {a["account_id"]: a for a in accounts}
+
+    def all_results():
+        # A coordinator's results are mostly those its workers stored in the queue.
+        return completed + (queue.results() if args.queue else [])
+
+    def sort_results(results):
+        # Grouped units finish out of policy order; keep the manifest in account,
+        # region, then policy order.
+        account_order = {a["account_id"]: i for i, a in enumerate(accounts)}
+        order = {p["name"]: i for i, p in enumerate(policies)}
+        return sorted(results, key=lambda r: (account_order[r["account_id"]], regions.index(r["region"]),
+                                              order[r["name"]]))
+
+    def merged_results():
+        # A resumed run's earlier results stand until this attempt replaces them.
+        results = all_results()
+        fresh = {(r["account_id"], r["region"], r["name"]) for r in results}
+        return sort_results([r for key, r in previous.items() if key not in fresh] + results)
+
+    def build_manifest(complete):
+        # Digests go to digest.json, not the manifest.
+        results = [{k: v for k, v in r.items() if k != "digest"} for r in merged_results()]
+        manifest = {
+            "run_id": run_id,
+            "timestamp": utc_iso(),
+            "complete": complete,
+            "account_id": ",".join(a["account_id"] for a in accounts),
+            "accounts": [{"account_id": a["account_id"], "name": a["name"]} for a in accounts],
+            "region": ",".join(regions),
+            "regions": regions,
+            "per_account": per_account,
+            "per_region": per_region,
+            "policies_run": [p["name"] for p in policies],
+            "output_dir": run_output_dir,
+            "engine": args.engine,
+            "workers": workers,
+            "region_workers": region_workers,
+            "account_workers": account_workers,
+            "batch_size": args.batch_size,
+            "group_by_resource": args.engine == "api" or args.group_by_resource,
+            "compress": args.compress,
+            "results": results,
+            "throttling": throttle.summary(),
+        }
+        if args.incremental:
+            manifest["incremental"] = {
+                "max_age_minutes": args.max_age,
+                "reused": sum(1 for r in results if "reused_from" in r),
+            }
+        if args.record or args.replay:
+            manifest["recording"] = {"mode": "record" if args.record else "replay",
+                                     "path": args.record or args.replay}
+        if args.resume:
+            manifest["resumed"] = {"kept": len(kept), "timestamp": utc_iso(run_started)}
+        if args.queue:
+            manifest["queue"] = {"path": QUEUE_FILE, "units": queue.counts(), "workers": queue.workers()}
+        return manifest
+
+    def checkpoint(results):
+        """Record finished results and rewrite the manifest, so a killed run can be resumed."""
+        with checkpoint_lock:
+            completed.extend(results)
+            manifest = build_manifest(complete=False)
+            write_manifest(manifest_path, manifest)
+            runindex.record_run(OUTPUTS_DIR, manifest, run_output_dir)
 
-    # Also save run_id in state for the summarizer
+    def plan_target(account, region):
+        """Build a target's engine and its units, longest first; returns (engine, units, reused)."""
+        engine = make_engine(account, region)
+        pending = [p for p in policies if (account["account_id"], region, p["name"]) not in done]
+        if args.resume:
+            # Clear what a killed or failed attempt left behind, so stale
+            # metadata is never read as this attempt's result.
+            for p in pending:
+                shutil.rmtree(os.path.join(engine.run_output_dir, p["name"]), ignore_errors=True)
+        reused = []
+        if args.incremental and pending:
+            pending, reused = reuse_previous(account, engine, pending)
+            if reused:
+                checkpoint(reused)
+        units = longest_first(history, account["account_id"], region, make_target_units(engine, pending))
+        for unit in units:
+            unit["timeout"] = unit_timeout(history, account["account_id"], region, unit, POLICY_TIMEOUT)
+        return engine, units, reused
+
+    def run_target(account, region):
+        engine, units, reused = plan_target(account, region)
+        return run_region(engine, units, workers, run_output_dir, checkpoint, throttle, args.compress) + reused
+
+    def enqueue_target(account, region):
+        engine, units, reused = plan_target(account, region)
+        engine.close()
+        costs = [unit_cost(history, account["account_id"], region, unit) for unit in units]
+        queue.enqueue(account["account_id"], region, units,
+                      [UNKNOWN_COST if cost is None else cost for cost in costs])
+        return reused
+
+    def assume_failure(account, region, pending, error):
+        now = time.time()
+        failed = []
+        for p in pending:
+            result = policy_result(p, None, now, now)
+            result.update(
+                account_id=account["account_id"],
+                region=region,
+                output_path=os.path.relpath(os.path.join(target_dir(account, region), p["name"]), run_output_dir),
+                error=f"assume role failed: {error}"[:500],
+            )
+            failed.append(result)
+        return failed
+
+    def run_account(account, run=run_target):
+        if account["credentials"]:
+            try:
+                account["credentials"].get()
+            except Exception as e:
+                # Record the failure against every policy and region rather than
+                # aborting the other accounts.
+                print(f"  {account['name']}: could not assume {account['role']}: {e}")
+                failed = [r for region in regions for r in assume_failure(account, region, policies, e)]
+                checkpoint(failed)
+                return failed
+        # Regions are independent API endpoints, so they run side by side,
+        # each with its own bounded pool of custodian invocations.
+        with ThreadPoolExecutor(max_workers=region_workers) as pool:
+            futures = [pool.submit(run, account, region) for region in regions]
+            return [r for f in futures for r in f.result()]
+
+    def work():
+        """Claim and run queued units, ``workers`` at a time, until none is left to claim."""
+        engines = {}
+        engines_lock = threading.Lock()
+
+        def engine_for(account, region):
+            with engines_lock:
+                key = (account["account_id"], region)
+                if key not in engines:
+                    engines[key] = make_engine(account, region)
+                return engines[key]
+
+        def loop():
+            while True:
+                claim = queue.claim(worker)
+                if claim is None:
+                    return
+                account, region, unit = accounts_by_id[claim["account_id"]], claim["region"], claim["unit"]
+                try:
+                    if account["credentials"]:
+                        account["credentials"].get()
+                except Exception as e:
+                    print(f"  {account['name']}: could not assume {account['role']}: {e}")
+                    results = assume_failure(account, region, unit["policies"], e)
+                else:
+                    engine = engine_for(account, region)
+                    if claim["attempts"] > 1:
+                        # Another worker's lease ran out on this unit; clear what it left behind.
+                        for p in unit["policies"]:
+                            shutil.rmtree(os.path.join(engine.run_output_dir, p["name"]), ignore_errors=True)
+                    results = execute(engine, unit, run_output_dir, throttle, args.compress)
+                queue.complete(claim["id"], worker, results)
+                queue.report_worker(worker, throttle.summary())
+                if args.queue:
+                    checkpoint([])
+
+        with LeaseRenewer(queue, worker), ThreadPoolExecutor(max_workers=workers) as pool:
+            for f in [pool.submit(loop) for _ in range(workers)]:
+                f.result()
+        for engine in engines.values():
+            engine.close()
+
+    if args.join:
+        print(f"Joining {run_id} as {worker} ({args.engine} engine, {workers} worker(s))")
+        work()
+        events.close()
+        done_units = next((w["units"] for w in queue.workers() if w["worker"] == worker), 0)
+        print(f"\nNo units left to claim in {run_id}; this worker ran {done_units}.")
+        return
+
+    print(f"Run ID:     {run_id}")
+    print(f"Account:    {', '.join(a['account_id'] for a in accounts)}")
+    print(f"Region:     {', '.join(regions)}")
+    print(f"Policies:   {len(policies)}")
+    print(f"Engine:     {args.engine}")
+    print(f"Workers:    {workers} per region, {region_workers} region(s), {account_workers} account(s) at a time")
+    print(f"Output dir: {run_output_dir}")
+    print()
+
+    # Point the summarizer at this run straight away; the manifest is
+    # checkpointed as policies finish, so even a killed run can be summarized.
     state["last_run_id"] = run_id
     state["last_run_output_dir"] = run_output_dir
-    from common import save_state
     save_state(state)
+    manifest = build_manifest(complete=False)
+    write_manifest(manifest_path, manifest)
+    # Indexed from the start, so tools can find a run that is killed part way.
+    runindex.record_run(OUTPUTS_DIR, manifest, run_output_dir)
+
+    if args.queue:
+        with ThreadPoolExecutor(max_workers=account_workers) as pool:
+            futures = [pool.submit(run_account, account, enqueue_target) for account in accounts]
+            for f in futures:
+                f.result()
+        units = queue.counts()["pending"]
+        print(f"Queued {units} units. Add workers with: 03_run_custodian.py --join {run_id}\n")
+        # Work alongside the joined runners, then wait for their units,
+        # taking over any whose lease runs out.
+        while True:
+            work()
+            counts = queue.counts()
+            if not counts["pending"] and not counts["leased"]:
+                break
+            checkpoint([])
+            time.sleep(POLL_INTERVAL)
+    else:
+        with ThreadPoolExecutor(max_workers=account_workers) as pool:
+            futures = [pool.submit(run_account, account) for account in accounts]
+            for f in futures:
+                f.result()
+
+    results = sort_results(all_results())
+    write_digest(run_output_dir, run_id, merged_results())
+    manifest = build_manifest(complete=True)
+    write_manifest(manifest_path, manifest)
+    runindex.record_run(OUTPUTS_DIR, manifest, run_output_dir)
+    events.close()
+
+    for r in results:
+        if "reused_from" in r or "snapshot" in r or args.replay:
+            continue
+        metadata = read_policy_metadata(os.path.dirname(os.path.join(run_output_dir, r["output_path"])), r["name"])
+        if metadata and "duration" in metadata.get("execution", {}):
+            record_duration(history, r["account_id"], r["region"], r["name"], metadata["execution"]["duration"])
+        elif r["returncode"] is None and "error" not in r:
+            # Timed out: what it was allowed is a lower bound, so the next
+            # timeout grows instead of cutting it off again.
+            record_duration(history, r["account_id"], r["region"], r["name"], r["duration"])
+    save_history(history)
+
+    if args.incremental:
+        for r in results:
+            if "reused_from" in r:
+                continue
+            key = store_key(r["account_id"], r["region"], r["name"])
+            if r["status"] == "ok":
+                fingerprints = target_fingerprints[(r["account_id"], r["region"])]
+                reuse_store[key] = make_record(run_id, policies_by_name[r["name"]], r,
+                                               os.path.join(run_output_dir, r["output_path"]),
+                                               fingerprints, run_started)
+            else:
+                reuse_store.pop(key, None)
+        save_reuse_store(reuse_store)
 
-    print(f"\nAll policies executed. Manifest: {manifest_path}")
+    if args.resume:
+        print(f"\nResumed {run_id}: {len(kept)} kept, {len(results)} executed. Manifest: {manifest_path}")
+    else:
+        print(f"\nAll policies executed. Manifest: {manifest_path}")
 
 
 if __name__ == "__main__":
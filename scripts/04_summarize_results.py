@@ -1,11 +1,48 @@
 #!/usr/bin/env python3
-"""Parse Cloud Custodian outputs and print a PASS/FAIL summary table."""
+"""Parse Cloud Custodian outputs and print a PASS/FAIL summary table.
 
+With --history N and/or --since, print PASS/FAIL and violation trends across
+many runs instead. Each run's per-policy counts are cached in
+outputs/summary_cache.json, keyed by its manifest's mtime and size, so
+repeated reports never parse an unchanged run again.
+"""
+
+import argparse
+import calendar
 import json
 import os
 import sys
+import tempfile
+import time
 from tabulate import tabulate
 from common import load_state, POLICIES_DIR, OUTPUTS_DIR
+from runfiles import policy_outputs, count_resources, read_digest, archived_run, extract_run, run_time
+import runindex
+
+CACHE_FILE = os.path.join(OUTPUTS_DIR, "summary_cache.json")
+SINCE_UNITS = {"h": 3600, "d": 86400, "w": 7 * 86400}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=int, metavar="N",
+                        help="summarise trends over the last N runs")
+    parser.add_argument("--since", metavar="WHEN",
+                        help="summarise trends over runs since a date (2024-06-01) or for a period (12h, 7d, 2w)")
+    return parser.parse_args()
+
+
+def parse_since(value):
+    """'7d', '12h', '2w' (ago) or an ISO date/time (UTC) -> epoch."""
+    value = value.strip()
+    if value[-1:].lower() in SINCE_UNITS and value[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(value[:-1]) * SINCE_UNITS[value[-1].lower()]
+    for fmt in ("%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise SystemExit(f"ERROR: --since takes a date (2024-06-01) or a period (12h, 7d, 2w), not {value!r}")
 
 
 def load_expectations():
@@ -16,20 +53,164 @@ def load_expectations():
     return {}
 
 
-def count_violations(output_dir, policy_name):
-    """Read the resources.json file for a policy and count violations."""
-    resources_file = os.path.join(output_dir, policy_name, "resources.json")
-    if not os.path.exists(resources_file):
+def count_violations(policy_dir):
+    """Count a policy's violations by streaming its resources.json, never loading it whole."""
+    count = count_resources(policy_dir)
+    if count is None:
         return 0, "no output"
-    with open(resources_file) as f:
-        resources = json.load(f)
-    return len(resources), "ok"
+    return count, "ok"
+
+
+def policy_counts(manifest, run_dir):
+    """(output, violations) for each policy output of a run; violations is None without resources.json.
+
+    digest.json has every policy's count; only runs without one (older or
+    killed runs) are counted from their resources.json files.
+    """
+    digest = read_digest(run_dir) or {}
+    counts = []
+    for output in policy_outputs(manifest, run_dir):
+        entry = digest.get(os.path.relpath(output["path"], run_dir))
+        if entry is None:
+            violations, note = count_violations(output["path"])
+            counts.append((output, violations if note == "ok" else None))
+        else:
+            counts.append((output, entry["violations"]))
+    return counts
+
+
+def outcome(violations):
+    # PASS = 0 violations (policy found no offending resources)
+    # FAIL = >0 violations (policy found offending resources)
+    if violations is None:
+        return "SKIP"
+    return "FAIL" if violations > 0 else "PASS"
+
+
+def load_cache():
+    if os.path.exists(CACHE_FILE):
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    return {}
+
+
+def save_cache(cache):
+    tmp = CACHE_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp, CACHE_FILE)
+
+
+def aggregate(manifest, run_dir, key):
+    return {
+        "key": key,
+        "timestamp": manifest["timestamp"],
+        "complete": manifest.get("complete", True),
+        "outputs": [{"name": o["name"], "account_id": o["account_id"], "region": o["region"], "violations": v}
+                    for o, v in policy_counts(manifest, run_dir)],
+    }
+
+
+def run_aggregate(run_id, cache):
+    """A run's per-policy counts, from the cache while its manifest is unchanged.
+
+    Returns (aggregate or None, whether the run had to be read).
+    """
+    run_dir = os.path.join(OUTPUTS_DIR, run_id)
+    manifest_path = os.path.join(run_dir, "manifest.json")
+    cached = cache.get(run_id)
+    if os.path.exists(manifest_path):
+        st = os.stat(manifest_path)
+        key = [st.st_mtime_ns, st.st_size]
+        if cached and cached["key"] == key:
+            return cached, False
+        with open(manifest_path) as f:
+            cache[run_id] = aggregate(json.load(f), run_dir, key)
+        return cache[run_id], True
+    if cached:
+        # Compacted runs no longer change.
+        return cached, False
+    archive = archived_run(run_dir)
+    if archive is None:
+        return None, False
+    with tempfile.TemporaryDirectory() as tmp:
+        extracted = extract_run(archive, run_id, tmp)
+        with open(os.path.join(extracted, "manifest.json")) as f:
+            cache[run_id] = aggregate(json.load(f), extracted, None)
+    return cache[run_id], True
+
+
+def select_runs(history, since):
+    """Run ids to report on, newest first: from the run index, or by listing outputs/ without one."""
+    runs = [r["run_id"] for r in runindex.list_runs(OUTPUTS_DIR, limit=history, since=since)]
+    if runs:
+        return runs
+    listed = sorted((run_time(name), name) for name in os.listdir(OUTPUTS_DIR) if run_time(name) is not None)
+    runs = [name for started, name in reversed(listed) if since is None or started >= since]
+    return runs[:history] if history else runs
+
+
+def print_history(history, since):
+    run_ids = select_runs(history, since)
+    if not run_ids:
+        print("ERROR: No runs found for that period.")
+        sys.exit(1)
+    cache = load_cache()
+    runs, parsed = [], 0
+    for run_id in reversed(run_ids):
+        agg, read = run_aggregate(run_id, cache)
+        parsed += read
+        if agg is not None:
+            runs.append((run_id, agg))
+    if parsed:
+        save_cache(cache)
+
+    # One row per run, oldest first.
+    rows = []
+    policies = {}
+    for run_id, agg in runs:
+        results = [outcome(o["violations"]) for o in agg["outputs"]]
+        rows.append([run_id, agg["timestamp"] + ("" if agg["complete"] else " (incomplete)"),
+                     results.count("PASS"), results.count("FAIL"), results.count("SKIP"),
+                     sum(o["violations"] or 0 for o in agg["outputs"])])
+        # A policy fails a run when any of its accounts or regions has violations.
+        per_run = {}
+        for o in agg["outputs"]:
+            if o["violations"] is not None:
+                per_run[o["name"]] = per_run.get(o["name"], 0) + o["violations"]
+        for name, violations in per_run.items():
+            policies.setdefault(name, []).append(violations)
+    print(tabulate(rows, headers=["Run ID", "Timestamp", "PASS", "FAIL", "SKIP", "Violations"], tablefmt="grid"))
+    print()
+
+    trend_rows = []
+    for name, series in sorted(policies.items()):
+        fails = sum(1 for v in series if v > 0)
+        trend_rows.append([name, len(series), fails, f"{100 * fails / len(series):.0f}%",
+                           f"{series[0]} -> {series[-1]}", outcome(series[-1])])
+    print(tabulate(trend_rows, headers=["Policy", "Runs", "FAIL", "Fail rate", "Violations", "Latest"],
+                   tablefmt="grid"))
+    print()
+    print(f"{len(runs)} runs from {runs[0][1]['timestamp']} to {runs[-1][1]['timestamp']}; "
+          f"{parsed} read, {len(runs) - parsed} from {os.path.basename(CACHE_FILE)}")
 
 
 def main():
+    args = parse_args()
+    if args.history or args.since:
+        print_history(args.history, parse_since(args.since) if args.since else None)
+        return
+
+    # state.json points at the run 03_run_custodian.py last started or resumed.
+    # Without one (or once it is gone) the run index finds the latest run
+    # without listing outputs/.
     state = load_state()
     run_id = state.get("last_run_id")
     output_dir = state.get("last_run_output_dir")
+    if not (run_id and output_dir and os.path.isdir(output_dir)):
+        latest = runindex.latest_run(OUTPUTS_DIR)
+        if latest and os.path.isdir(runindex.run_dir(OUTPUTS_DIR, latest)):
+            run_id, output_dir = latest["run_id"], runindex.run_dir(OUTPUTS_DIR, latest)
 
     if not run_id or not output_dir:
         print("ERROR: No run found. Execute 03_run_custodian.py first.")
@@ -48,33 +229,49 @@ def main():
     print(f"Run ID:    {manifest['run_id']}")
     print(f"Timestamp: {manifest['timestamp']}")
     print(f"Account:   {manifest['account_id']}")
-    print(f"Region:    {manifest['region']}")
+    print(f"Region:    {', '.join(manifest.get('regions') or [manifest['region']])}")
+    counts = policy_counts(manifest, output_dir)
+    if manifest.get("complete") is False:
+        # In progress or killed: only the units finished so far are in the manifest.
+        expected_results = len(manifest.get("policies_run", [])) * len(manifest.get("accounts") or [None]) \
+            * len(manifest.get("regions") or [None])
+        print(f"Status:    incomplete (still running or killed), {len(counts)} of {expected_results} policy "
+              f"results so far; the rest can be run with 03_run_custodian.py --resume {manifest['run_id']}")
     print()
+    if not counts:
+        print("No policy has finished in this run yet.")
+        return
 
+    multi_account = len(manifest.get("accounts", [])) > 1
+    multi_region = len(manifest.get("regions", [])) > 1
     rows = []
     pass_count = 0
     fail_count = 0
 
-    for policy_name in manifest["policies_run"]:
-        violations, note = count_violations(output_dir, policy_name)
-
-        # PASS = 0 violations (policy found no offending resources)
-        # FAIL = >0 violations (policy found offending resources)
-        if note != "ok":
-            result = "SKIP"
-        elif violations > 0:
-            result = "FAIL"
+    for output, violations in counts:
+        policy_name = output["name"]
+        result = outcome(violations)
+        if result == "FAIL":
             fail_count += 1
-        else:
-            result = "PASS"
+        elif result == "PASS":
             pass_count += 1
+        violations = violations or 0
 
         expected = expectations.get(policy_name, "N/A")
         match = "Y" if result == expected else ("N" if expected != "N/A" else "-")
 
-        rows.append([policy_name, violations, result, expected, match])
+        row = [policy_name, violations, result, expected, match]
+        if multi_region:
+            row = [output["region"]] + row
+        if multi_account:
+            row = [output["account_id"]] + row
+        rows.append(row)
 
     headers = ["Policy", "Violations", "Result", "Expected", "Match"]
+    if multi_region:
+        headers = ["Region"] + headers
+    if multi_account:
+        headers = ["Account"] + headers
     print(tabulate(rows, headers=headers, tablefmt="grid"))
     print()
     print(f"Total: {pass_count} PASS, {fail_count} FAIL, {len(rows)} total")
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Compare two runs: new, resolved and persisting violations per policy.
+
+With no arguments the latest run is compared with the one before it; with
+one, that run is compared with the latest. Resource ids are hashed into
+sets while each resources.json is streamed (or read from digest.json), so
+memory stays small even for hundreds of thousands of resources; policies
+whose digests carry the same id hash are skipped without reading anything.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from contextlib import ExitStack
+from common import OUTPUTS_DIR
+from runfiles import (archived_run, extract_run, iter_resources, output_resource_type, policy_outputs, read_digest,
+                      resource_id, run_time)
+import runindex
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base", nargs="?", help="earlier run id (default: the run before the latest)")
+    parser.add_argument("head", nargs="?", help="later run id (default: the latest run)")
+    parser.add_argument("--policy", action="append",
+                        help="only this policy (repeatable)")
+    parser.add_argument("--limit", type=int, default=20,
+                        help="resource ids listed per policy and change (default: 20, 0 for counts only)")
+    parser.add_argument("--json", action="store_true",
+                        help="print the diff as JSON instead of text")
+    return parser.parse_args()
+
+
+def latest_runs(count):
+    """The newest run ids, newest first: from the run index, or by listing outputs/ without one."""
+    runs = [r["run_id"] for r in runindex.list_runs(OUTPUTS_DIR, limit=count)]
+    if len(runs) == count:
+        return runs
+    listed = sorted((run_time(name), name) for name in os.listdir(OUTPUTS_DIR) if run_time(name) is not None)
+    return [name for _, name in reversed(listed)][:count]
+
+
+def open_run(run_id, stack):
+    """(manifest, run_dir) for a run, unpacking it from its day archive when it has been compacted."""
+    run_dir = os.path.join(OUTPUTS_DIR, run_id)
+    if not os.path.isdir(run_dir):
+        archive = archived_run(run_dir)
+        if archive is None:
+            print(f"ERROR: Run {run_id} not found in outputs/ or its archive.")
+            sys.exit(1)
+        run_dir = extract_run(archive, run_id, stack.enter_context(tempfile.TemporaryDirectory()))
+    with open(os.path.join(run_dir, "manifest.json")) as f:
+        return json.load(f), run_dir
+
+
+def run_outputs(manifest, run_dir, wanted):
+    """Policy outputs keyed by (policy, account, region), each with its digest entry if any."""
+    digest = read_digest(run_dir) or {}
+    outputs = {}
+    for output in policy_outputs(manifest, run_dir):
+        if wanted and output["name"] not in wanted:
+            continue
+        output["digest"] = digest.get(os.path.relpath(output["path"], run_dir))
+        outputs[(output["name"], output["account_id"], output["region"])] = output
+    return outputs
+
+
+def iter_ids(output):
+    """Stream one output's resource ids: listed in its digest, or read from resources.json."""
+    entry = output["digest"]
+    if entry and "resource_ids" in entry:
+        yield from entry["resource_ids"]
+        return
+    rtype = output_resource_type(output)
+    for r in iter_resources(output["path"]):
+        yield resource_id(r, rtype)
+
+
+def id_hash(rid):
+    return hashlib.blake2b(rid.encode(), digest_size=8).digest()
+
+
+def hashed(output):
+    return {id_hash(rid) for rid in iter_ids(output)} if output else set()
+
+
+def missing(output, other, limit):
+    """Count the distinct ids of ``output`` whose hash is not in ``other``; list the first ``limit`` of them."""
+    count, ids, seen = 0, [], set()
+    for rid in iter_ids(output) if output else ():
+        h = id_hash(rid)
+        if h not in other and h not in seen:
+            seen.add(h)
+            count += 1
+            if len(ids) < limit:
+                ids.append(rid)
+    return count, ids
+
+
+def diff_output(base, head, limit):
+    if base and head and base["digest"] and head["digest"] and "ids_sha256" in base["digest"] \
+            and base["digest"]["ids_sha256"] == head["digest"].get("ids_sha256"):
+        return {"new": 0, "resolved": 0, "persisting": head["digest"]["violations"] or 0,
+                "new_ids": [], "resolved_ids": []}
+    base_set, head_set = hashed(base), hashed(head)
+    new, new_ids = missing(head, base_set, limit)
+    resolved, resolved_ids = missing(base, head_set, limit)
+    return {"new": new, "resolved": resolved, "persisting": len(head_set & base_set),
+            "new_ids": new_ids, "resolved_ids": resolved_ids}
+
+
+def main():
+    args = parse_args()
+    base_id, head_id = args.base, args.head
+    if base_id is None:
+        runs = latest_runs(2)
+        if len(runs) < 2:
+            print("ERROR: Need two runs to compare. Execute 03_run_custodian.py again first.")
+            sys.exit(1)
+        head_id, base_id = runs
+    elif head_id is None:
+        runs = latest_runs(1)
+        if not runs:
+            print("ERROR: No runs found to compare with. Execute 03_run_custodian.py first.")
+            sys.exit(1)
+        head_id = runs[0]
+    wanted = set(args.policy or [])
+
+    with ExitStack() as stack:
+        base_outputs = run_outputs(*open_run(base_id, stack), wanted)
+        head_outputs = run_outputs(*open_run(head_id, stack), wanted)
+        diffs = []
+        for key in sorted(set(base_outputs) | set(head_outputs)):
+            base, head = base_outputs.get(key), head_outputs.get(key)
+            d = diff_output(base, head, args.limit)
+            d.update(policy=key[0], account_id=key[1], region=key[2],
+                     only_in="base" if head is None else "head" if base is None else None)
+            diffs.append(d)
+
+    totals = {k: sum(d[k] for d in diffs) for k in ("new", "resolved", "persisting")}
+    if args.json:
+        print(json.dumps({"base": base_id, "head": head_id, "totals": totals, "policies": diffs}, indent=2))
+        return
+
+    multi = len({(d["account_id"], d["region"]) for d in diffs}) > 1
+    print(f"Diff {base_id} -> {head_id}")
+    print()
+    for d in diffs:
+        label = d["policy"] + (f" [{d['account_id']}/{d['region']}]" if multi else "")
+        note = f" (only in {d['only_in']})" if d["only_in"] else ""
+        print(f"{label}: {d['new']} new, {d['resolved']} resolved, {d['persisting']} persisting{note}")
+        for rid in d["new_ids"]:
+            print(f"  + {rid}")
+        if d["new_ids"] and d["new"] > len(d["new_ids"]):
+            print(f"  + ... {d['new'] - len(d['new_ids'])} more")
+        for rid in d["resolved_ids"]:
+            print(f"  - {rid}")
+        if d["resolved_ids"] and d["resolved"] > len(d["resolved_ids"]):
+            print(f"  - ... {d['resolved'] - len(d['resolved_ids'])} more")
+    print()
+    print(f"Total: {totals['new']} new, {totals['resolved']} resolved, {totals['persisting']} persisting")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,107 @@
 #!/usr/bin/env python3
-"""Clean up all AWS resources created by this POC."""
+"""Clean up all AWS resources created by this POC.
 
+Removes the demo set and any fleet (01_create_resources.py --buckets/
+--instances/--volumes) recorded in state.json. Instances are terminated in
+batches and their termination is awaited while volumes and buckets are
+deleted. Buckets are emptied in parallel, each with 1000-key DeleteObjects
+batches spread over a thread pool. Volumes still attached to a terminating
+instance are deleted once it is gone.
+"""
+
+import argparse
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from botocore.exceptions import ClientError
-from common import load_state, save_state
+from common import load_state, save_state, instance_states, wait_all, when_ready
+from throttle import Throttle, configure_retries
+
+TERMINATE_BATCH = 500   # instance ids per TerminateInstances call
+DELETE_BATCH = 1000     # keys per DeleteObjects call (the S3 maximum)
+TERMINATE_TIMEOUT = 600
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=16,
+                        help="concurrent API calls (default: 16)")
+    parser.add_argument("--rate-limit", type=float, default=20,
+                        help="API calls/s per service, halved on throttling and recovered gradually (default: 20)")
+    return parser.parse_args()
+
+
+def state_ids(state, single, fleet_key):
+    """Ids of one kind of resource: the demo one and the fleet's, without repeats."""
+    ids = [state[single]] if state.get(single) else []
+    return list(dict.fromkeys(ids + state.get("fleet", {}).get(fleet_key, [])))
+
+
+def terminate_instances(ec2, instance_ids, errors):
+    """Start terminating instances in batches; return the ids now terminating."""
+    print(f"Terminating {len(instance_ids)} EC2 instance(s)")
+    terminating, gone = [], 0
+    for start in range(0, len(instance_ids), TERMINATE_BATCH):
+        batch = instance_ids[start:start + TERMINATE_BATCH]
+        try:
+            ec2.terminate_instances(InstanceIds=batch)
+            terminating += batch
+            continue
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidInstanceID.NotFound":
+                errors.append(f"terminating {len(batch)} instance(s): {e}")
+                continue
+        # One unknown id fails the whole call, so go through the batch one by one.
+        for instance_id in batch:
+            try:
+                ec2.terminate_instances(InstanceIds=[instance_id])
+                terminating.append(instance_id)
+            except ClientError as e:
+                if e.response["Error"]["Code"] == "InvalidInstanceID.NotFound":
+                    gone += 1
+                else:
+                    errors.append(f"terminating {instance_id}: {e}")
+    print(f"  Termination initiated for {len(terminating)} instance(s)"
+          f"{f', {gone} already gone' if gone else ''}.")
+    return terminating
+
+
+def wait_terminated(ec2, instance_ids):
+    wait_all(instance_ids, lambda batch: instance_states(ec2, batch), "terminated", "instances",
+             TERMINATE_TIMEOUT)
+
+
+def delete_volume(ec2, volume_id, retry_in_use=False):
+    """Delete a volume: "deleted", "gone", "in-use" (attached to an instance still terminating) or an error."""
+    try:
+        if retry_in_use:
+            when_ready(lambda: ec2.delete_volume(VolumeId=volume_id), ("VolumeInUse",))
+        else:
+            ec2.delete_volume(VolumeId=volume_id)
+        return "deleted"
+    except ClientError as e:
+        code = e.response["Error"]["Code"]
+        if code == "InvalidVolume.NotFound":
+            return "gone"
+        if code == "VolumeInUse":
+            return "in-use"
+        return f"deleting {volume_id}: {e}"
+
 
+def delete_keys(s3, bucket_name, keys):
+    resp = s3.delete_objects(Bucket=bucket_name, Delete={"Objects": keys, "Quiet": True})
+    failed = resp.get("Errors", [])
+    if failed:
+        raise RuntimeError(f"{len(failed)} object(s) not deleted from {bucket_name}: {failed[0].get('Message')}")
+    return len(keys)
 
-def delete_s3_bucket(s3, bucket_name):
-    """Remove public access, delete all objects, then delete the bucket."""
-    print(f"Cleaning up S3 bucket: {bucket_name}")
 
+def delete_s3_bucket(s3, bucket_name, delete_pool):
+    """Remove public access, delete every object version in parallel batches, then delete the bucket.
+
+    Returns the number of objects deleted, or None when the bucket was already gone.
+    """
     try:
         # 1. Block public access first
         s3.put_public_access_block(
@@ -23,80 +113,38 @@ def delete_s3_bucket(s3, bucket_name):
                 "RestrictPublicBuckets": True,
             },
         )
-        print("  Public access blocked.")
-    except ClientError:
-        pass
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchBucket":
+            return None
 
     try:
         # 2. Remove bucket policy
         s3.delete_bucket_policy(Bucket=bucket_name)
-        print("  Bucket policy removed.")
     except ClientError:
         pass
 
-    try:
-        # 3. Delete all objects (should be empty, but just in case)
-        paginator = s3.get_paginator("list_objects_v2")
+    # 3. Delete all objects and object versions (unversioned objects are listed with version "null").
+    # Pages are deleted while listing goes on, so list again until a pass finds nothing: a listing
+    # can stop short once the version its marker points at is gone.
+    deleted = 0
+    paginator = s3.get_paginator("list_object_versions")
+    while True:
+        batches = []
         for page in paginator.paginate(Bucket=bucket_name):
-            if "Contents" in page:
-                objects = [{"Key": obj["Key"]} for obj in page["Contents"]]
-                s3.delete_objects(Bucket=bucket_name, Delete={"Objects": objects})
-                print(f"  Deleted {len(objects)} objects.")
+            keys = [{"Key": v["Key"], "VersionId": v["VersionId"]}
+                    for v in page.get("Versions", []) + page.get("DeleteMarkers", [])]
+            for start in range(0, len(keys), DELETE_BATCH):
+                batches.append(delete_pool.submit(delete_keys, s3, bucket_name, keys[start:start + DELETE_BATCH]))
+        if not batches:
+            break
+        deleted += sum(f.result() for f in batches)
 
-        # 4. Delete all object versions (if versioning was enabled)
-        paginator = s3.get_paginator("list_object_versions")
-        for page in paginator.paginate(Bucket=bucket_name):
-            versions = []
-            for v in page.get("Versions", []):
-                versions.append({"Key": v["Key"], "VersionId": v["VersionId"]})
-            for v in page.get("DeleteMarkers", []):
-                versions.append({"Key": v["Key"], "VersionId": v["VersionId"]})
-            if versions:
-                s3.delete_objects(Bucket=bucket_name, Delete={"Objects": versions})
-    except ClientError:
-        pass
-
-    try:
-        s3.delete_bucket(Bucket=bucket_name)
-        print(f"  Bucket {bucket_name} deleted.")
-    except ClientError as e:
-        print(f"  ERROR deleting bucket: {e}")
-
-
-def terminate_ec2_instance(ec2, instance_id):
-    """Terminate the EC2 instance."""
-    print(f"Terminating EC2 instance: {instance_id}")
-    try:
-        ec2.terminate_instances(InstanceIds=[instance_id])
-        print(f"  Termination initiated for {instance_id}.")
-        # Wait briefly for termination to begin
-        waiter = ec2.get_waiter("instance_terminated")
-        print("  Waiting for termination (up to 2 min)...")
-        waiter.wait(InstanceIds=[instance_id], WaiterConfig={"Delay": 10, "MaxAttempts": 12})
-        print(f"  Instance {instance_id} terminated.")
-    except ClientError as e:
-        code = e.response["Error"]["Code"]
-        if code == "InvalidInstanceID.NotFound":
-            print(f"  Instance {instance_id} already gone.")
-        else:
-            print(f"  ERROR: {e}")
-
-
-def delete_ebs_volume(ec2, volume_id):
-    """Delete the EBS volume."""
-    print(f"Deleting EBS volume: {volume_id}")
-    try:
-        ec2.delete_volume(VolumeId=volume_id)
-        print(f"  Volume {volume_id} deleted.")
-    except ClientError as e:
-        code = e.response["Error"]["Code"]
-        if code == "InvalidVolume.NotFound":
-            print(f"  Volume {volume_id} already gone.")
-        else:
-            print(f"  ERROR: {e}")
+    s3.delete_bucket(Bucket=bucket_name)
+    return deleted
 
 
 def main():
+    args = parse_args()
     state = load_state()
     if not state:
         print("No state.json found. Nothing to clean up.")
@@ -107,26 +155,98 @@ def main():
     print(f"Prefix: {state.get('prefix', 'unknown')}")
     print()
 
-    s3 = boto3.client("s3", region_name=region)
-    ec2 = boto3.client("ec2", region_name=region)
+    throttle = Throttle(args.rate_limit)
+    configure_retries()
+    session = boto3.Session(region_name=region)
+    throttle.session_hook(lambda service: None)(session)
+    s3 = session.client("s3")
+    ec2 = session.client("ec2")
+
+    instance_ids = state_ids(state, "instance_id", "instances")
+    volume_ids = state_ids(state, "volume_id", "volumes")
+    bucket_names = state_ids(state, "bucket_name", "buckets")
+    errors = []
+    started = time.time()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool, \
+            ThreadPoolExecutor(max_workers=args.workers) as delete_pool, \
+            ThreadPoolExecutor(max_workers=1) as waiter:
+        # Terminate EC2 first (takes longest) and wait for it while everything else is deleted.
+        terminated = None
+        if instance_ids:
+            terminating = terminate_instances(ec2, instance_ids, errors)
+            if terminating:
+                print(f"  Waiting for termination (up to {TERMINATE_TIMEOUT // 60} min) in the background...")
+                terminated = waiter.submit(wait_terminated, ec2, terminating)
+
+        if volume_ids:
+            print(f"Deleting {len(volume_ids)} EBS volume(s)")
+        volume_futures = [(v, pool.submit(delete_volume, ec2, v)) for v in volume_ids]
+        if bucket_names:
+            print(f"Deleting {len(bucket_names)} S3 bucket(s)")
+        bucket_futures = [(b, pool.submit(delete_s3_bucket, s3, b, delete_pool)) for b in bucket_names]
+
+        outcomes = {}
+        in_use = []
+        for volume_id, future in volume_futures:
+            outcome = future.result()
+            if outcome == "in-use":
+                in_use.append(volume_id)
+            elif outcome in ("deleted", "gone"):
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            else:
+                errors.append(outcome)
+
+        deleted_buckets = gone_buckets = objects = 0
+        for bucket_name, future in bucket_futures:
+            try:
+                count = future.result()
+            except (ClientError, RuntimeError) as e:
+                errors.append(f"deleting bucket {bucket_name}: {e}")
+                continue
+            if count is None:
+                gone_buckets += 1
+            else:
+                deleted_buckets += 1
+                objects += count
+        if bucket_names:
+            print(f"  {deleted_buckets} bucket(s) deleted ({objects} objects)"
+                  f"{f', {gone_buckets} already gone' if gone_buckets else ''}.")
+
+        if terminated is not None:
+            try:
+                terminated.result()
+                print(f"  {len(terminating)} instance(s) terminated.")
+            except (ClientError, TimeoutError) as e:
+                errors.append(f"waiting for termination: {e}")
+
+        # Volumes that were attached are free once their instance has terminated.
+        if in_use:
+            print(f"  Deleting {len(in_use)} volume(s) detached by termination")
+        for outcome in pool.map(lambda v: delete_volume(ec2, v, retry_in_use=True), in_use):
+            if outcome in ("deleted", "gone"):
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            else:
+                errors.append(outcome)
+        if volume_ids:
+            gone_volumes = outcomes.get("gone", 0)
+            print(f"  {outcomes.get('deleted', 0)} volume(s) deleted"
+                  f"{f', {gone_volumes} already gone' if gone_volumes else ''}.")
 
-    # Terminate EC2 first (takes longest)
-    if state.get("instance_id"):
-        terminate_ec2_instance(ec2, state["instance_id"])
-
-    # Delete EBS volume
-    if state.get("volume_id"):
-        delete_ebs_volume(ec2, state["volume_id"])
-
-    # Delete S3 bucket
-    if state.get("bucket_name"):
-        delete_s3_bucket(s3, state["bucket_name"])
+    print()
+    print(f"Finished in {time.time() - started:.1f}s.")
+    if errors:
+        for e in errors[:10]:
+            print(f"  ERROR {e}")
+        if len(errors) > 10:
+            print(f"  ... {len(errors) - 10} more")
+        print(f"Cleanup incomplete: {len(errors)} error(s). Run it again to retry; state.json is kept as is.")
+        sys.exit(1)
 
     # Clear state
     state["cleaned_up"] = True
     save_state(state)
 
-    print()
     print("Cleanup complete. All demo resources removed.")
 
 
@@ -0,0 +1,104 @@
+"""Accounts file loading and cached assume-role credentials for multi-account runs."""
+
+import os
+import threading
+import time
+import boto3
+import yaml
+
+# Refresh assumed-role credentials this long before they expire, so a
+# custodian invocation started with them never outlives them.
+REFRESH_MARGIN = 600  # seconds
+SESSION_NAME = "cscc-poc-runner"
+
+
+def load_accounts(path):
+    """Read an accounts file (YAML or JSON).
+
+    Accepts the c7n-org layout, a top-level ``accounts:`` list whose entries
+    have ``account_id`` and ``role`` plus optional ``name`` and
+    ``external_id``.
+    """
+    with open(path) as f:
+        data = yaml.safe_load(f) or {}
+    accounts = []
+    for entry in data.get("accounts", []):
+        account_id = str(entry["account_id"])
+        accounts.append({
+            "account_id": account_id,
+            "name": entry.get("name", account_id),
+            "role": entry.get("role"),
+            "external_id": entry.get("external_id"),
+        })
+    return accounts
+
+
+class RoleCredentials:
+    """Assumed-role credentials for one account, shared by all its policy runs.
+
+    The role is assumed once and the credentials reused until they are within
+    REFRESH_MARGIN of expiry, instead of assuming the role per policy.
+    """
+
+    def __init__(self, role_arn, external_id=None, region=None):
+        self.role_arn = role_arn
+        self.external_id = external_id
+        self.region = region
+        self._lock = threading.Lock()
+        self._creds = None
+
+    def get(self):
+        """Return credential metadata (access_key, secret_key, token, expiry_time)."""
+        with self._lock:
+            if self._creds is None or self._creds["expires_at"] - time.time() < REFRESH_MARGIN:
+                self._creds = self._assume()
+            return self._creds["metadata"]
+
+    def _assume(self):
+        sts = boto3.client("sts", region_name=self.region)
+        kwargs = {"RoleArn": self.role_arn, "RoleSessionName": SESSION_NAME}
+        if self.external_id:
+            kwargs["ExternalId"] = self.external_id
+        creds = sts.assume_role(**kwargs)["Credentials"]
+        return {
+            "expires_at": creds["Expiration"].timestamp(),
+            "metadata": {
+                "access_key": creds["AccessKeyId"],
+                "secret_key": creds["SecretAccessKey"],
+                "token": creds["SessionToken"],
+                "expiry_time": creds["Expiration"].isoformat(),
+            },
+        }
+
+    def env(self):
+        """Environment for a custodian subprocess running as the assumed role."""
+        creds = self.get()
+        env = os.environ.copy()
+        env.pop("AWS_PROFILE", None)
+        env["AWS_ACCESS_KEY_ID"] = creds["access_key"]
+        env["AWS_SECRET_ACCESS_KEY"] = creds["secret_key"]
+        env["AWS_SESSION_TOKEN"] = creds["token"]
+        return env
+
+    def session(self, region):
+        """A boto3 session whose credentials refresh through this cache."""
+        from botocore.credentials import RefreshableCredentials
+        from botocore.session import get_session
+
+        botocore_session = get_session()
+        botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+            metadata=self.get(), refresh_using=self.get, method="sts-assume-role",
+        )
+        return boto3.Session(botocore_session=botocore_session, region_name=region)
+
+    def c7n_session_factory(self, region):
+        """A c7n session factory handing out sessions backed by this cache."""
+        from c7n.credentials import SessionFactory
+
+        credentials = self
+
+        class RoleSessionFactory(SessionFactory):
+            def __call__(self, assume=True, region=None):
+                return self.update(credentials.session(region or self.region))
+
+        return RoleSessionFactory(region)
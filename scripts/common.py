@@ -2,7 +2,9 @@
 
 import json
 import os
+import random
 import time
+from botocore.exceptions import ClientError
 
 STATE_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "state.json")
 POLICIES_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "policies")
@@ -23,11 +25,21 @@ DEFAULT_REGION = "us-east-1"
 
 SAFE_MODE = os.environ.get("SAFE_MODE", "false").lower() == "true"
 
+READY_TIMEOUT = 120  # seconds to wait for AWS to catch up (a resource becoming ready, a change propagating)
+READY_DELAY = 0.5    # first poll delay; doubled per attempt up to READY_MAX_DELAY
+READY_MAX_DELAY = 10
+DESCRIBE_BATCH = 500  # ids per Describe* call while waiting
+
 
 def get_region():
     return os.environ.get("AWS_DEFAULT_REGION", os.environ.get("AWS_REGION", DEFAULT_REGION))
 
 
+def utc_iso(ts=None):
+    """Format an epoch timestamp (default: now) the way manifests and state record times."""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts))
+
+
 def load_state():
     if os.path.exists(STATE_FILE):
         with open(STATE_FILE) as f:
@@ -35,10 +47,14 @@ def load_state():
     return {}
 
 
-def save_state(state):
-    with open(STATE_FILE, "w") as f:
+def save_state(state, quiet=False):
+    # Written aside and swapped in, so an interrupted save never leaves a truncated file.
+    tmp = STATE_FILE + ".tmp"
+    with open(tmp, "w") as f:
         json.dump(state, f, indent=2)
-    print(f"State saved to {STATE_FILE}")
+    os.replace(tmp, STATE_FILE)
+    if not quiet:
+        print(f"State saved to {STATE_FILE}")
 
 
 def get_prefix(state=None):
@@ -46,3 +62,61 @@ def get_prefix(state=None):
     if state and "prefix" in state:
         return state["prefix"]
     return PREFIX
+
+
+def backoff_delays(timeout=READY_TIMEOUT):
+    """Yield jittered, doubling delays until ``timeout`` seconds have been spent."""
+    deadline = time.monotonic() + timeout
+    delay = READY_DELAY
+    while time.monotonic() + delay < deadline:
+        yield delay
+        time.sleep(random.uniform(delay / 2, delay))
+        delay = min(READY_MAX_DELAY, delay * 2)
+
+
+def when_ready(call, codes, timeout=READY_TIMEOUT):
+    """Call ``call``, retrying with backoff while it fails with one of ``codes`` (AWS not caught up yet)."""
+    for _ in backoff_delays(timeout):
+        try:
+            return call()
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in codes:
+                raise
+    return call()
+
+
+def wait_for(check, what, timeout=READY_TIMEOUT):
+    """Poll ``check`` with backoff until it returns true."""
+    for _ in backoff_delays(timeout):
+        if check():
+            return
+    if not check():
+        raise TimeoutError(f"{what} not ready after {timeout}s")
+
+
+def wait_all(ids, states, wanted, what, timeout=READY_TIMEOUT):
+    """Poll ``states(batch)`` ({id: state}) with backoff until every id is in the ``wanted`` state."""
+    pending = list(ids)
+
+    def check():
+        nonlocal pending
+        remaining = []
+        for start in range(0, len(pending), DESCRIBE_BATCH):
+            batch = pending[start:start + DESCRIBE_BATCH]
+            current = states(batch)
+            remaining += [i for i in batch if current.get(i) != wanted]
+        pending = remaining
+        return not pending
+
+    wait_for(check, f"{len(pending)} {what}", timeout)
+
+
+def instance_states(ec2, instance_ids):
+    """{instance id: state name}, retrying while a new instance is not visible yet."""
+    resp = when_ready(lambda: ec2.describe_instances(InstanceIds=instance_ids), ("InvalidInstanceID.NotFound",))
+    return {i["InstanceId"]: i["State"]["Name"] for r in resp["Reservations"] for i in r["Instances"]}
+
+
+def volume_states(ec2, volume_ids):
+    resp = when_ready(lambda: ec2.describe_volumes(VolumeIds=volume_ids), ("InvalidVolume.NotFound",))
+    return {v["VolumeId"]: v["State"] for v in resp["Volumes"]}
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Apply retention to outputs/: keep recent runs in full, compact older ones into day archives.
+
+The last --keep runs and every run newer than --keep-days stay as they are.
+Older runs are compacted into outputs/archive/<YYYY-MM-DD>.tar.gz (UTC day
+of the run), keeping each run's manifest.json, digest.json and every policy's
+metadata.json and resources.json. Logs, event logs, batch files and work
+queues are dropped. Archives older than --raw-days lose their resources.json
+files too, keeping only manifests and metadata, and with --archive-days
+archives older than that are deleted. The CoreStack ingest reads compacted
+runs straight from their archive.
+"""
+
+import argparse
+import calendar
+import os
+import shutil
+import tarfile
+import time
+from common import load_state, OUTPUTS_DIR
+from runfiles import ARCHIVE_DIR, COMPRESSIONS, DIGEST_FILE, archive_path, run_time
+import runindex
+
+DAY = 86400
+RAW_NAMES = tuple("resources.json" + suffix for suffix in ("",) + tuple(COMPRESSIONS.values()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keep", type=int, default=10,
+                        help="most recent runs always kept in full (default: 10)")
+    parser.add_argument("--keep-days", type=float, default=7,
+                        help="runs newer than this many days are kept in full (default: 7)")
+    parser.add_argument("--raw-days", type=float, default=30,
+                        help="archives older than this many days keep manifests and metadata only (default: 30)")
+    parser.add_argument("--archive-days", type=float,
+                        help="delete archives older than this many days (default: keep them)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print what would be compacted or deleted without changing anything")
+    return parser.parse_args()
+
+
+def list_runs():
+    """Run directories under outputs/, newest first, as (run_id, started)."""
+    runs = []
+    for name in os.listdir(OUTPUTS_DIR):
+        started = run_time(name)
+        if started is not None and os.path.isdir(os.path.join(OUTPUTS_DIR, name)):
+            runs.append((name, started))
+    return sorted(runs, key=lambda r: r[1], reverse=True)
+
+
+def is_raw(name):
+    return os.path.basename(name) in RAW_NAMES
+
+
+def run_members(run_id, keep_raw):
+    """(path on disk, name in archive) for the files of a run that are kept when it is compacted."""
+    run_dir = os.path.join(OUTPUTS_DIR, run_id)
+    members = []
+    for root, dirs, files in os.walk(run_dir):
+        dirs.sort()
+        for name in sorted(files):
+            rel = os.path.relpath(os.path.join(root, name), run_dir)
+            if rel in ("manifest.json", DIGEST_FILE) or name == "metadata.json" or (keep_raw and is_raw(name)):
+                members.append((os.path.join(root, name), f"{run_id}/{rel}"))
+    return members
+
+
+def rewrite_archive(path, run_ids=(), keep_raw=True):
+    """Write ``path`` again with the given runs added, dropping raw resources when ``keep_raw`` is off.
+
+    The new archive replaces the old one only once it is complete, so an
+    interrupted compaction leaves both the archive and the run directories.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with tarfile.open(tmp, "w:gz") as out:
+        if os.path.exists(path):
+            with tarfile.open(path, "r:gz") as old:
+                for member in old:
+                    if member.name.split("/", 1)[0] in run_ids or (not keep_raw and is_raw(member.name)):
+                        continue
+                    out.addfile(member, old.extractfile(member) if member.isfile() else None)
+        for run_id in run_ids:
+            for disk_path, arcname in run_members(run_id, keep_raw):
+                out.add(disk_path, arcname=arcname)
+    os.replace(tmp, path)
+
+
+def has_raw(path):
+    with tarfile.open(path, "r:gz") as tar:
+        return any(is_raw(name) for name in tar.getnames())
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def main():
+    args = parse_args()
+    if not os.path.isdir(OUTPUTS_DIR):
+        print("Nothing to do: no outputs/ directory.")
+        return
+    now = time.time()
+    # The run the summarizer points at is never compacted underneath it.
+    protected = os.path.basename(os.path.normpath(load_state().get("last_run_output_dir") or ""))
+
+    runs = list_runs()
+    compact = [(run_id, started) for i, (run_id, started) in enumerate(runs)
+               if i >= args.keep and started < now - args.keep_days * DAY and run_id != protected]
+    by_archive = {}
+    for run_id, started in compact:
+        by_archive.setdefault(archive_path(OUTPUTS_DIR, run_id), []).append((run_id, started))
+
+    print(f"Runs:      {len(runs)} in outputs/, {len(runs) - len(compact)} kept in full, {len(compact)} to compact")
+    freed = 0
+    for path, day_runs in sorted(by_archive.items()):
+        keep_raw = min(started for _, started in day_runs) >= now - args.raw_days * DAY
+        run_ids = [run_id for run_id, _ in day_runs]
+        size = sum(dir_size(os.path.join(OUTPUTS_DIR, run_id)) for run_id in run_ids)
+        print(f"  {os.path.basename(path)}: {len(run_ids)} run(s), {size / 1e6:.1f} MB"
+              f"{'' if keep_raw else ' (manifests and metadata only)'}")
+        if args.dry_run:
+            continue
+        before = os.path.getsize(path) if os.path.exists(path) else 0
+        rewrite_archive(path, run_ids, keep_raw)
+        runindex.set_location(OUTPUTS_DIR, run_ids, os.path.relpath(path, OUTPUTS_DIR))
+        for run_id in run_ids:
+            shutil.rmtree(os.path.join(OUTPUTS_DIR, run_id))
+        freed += size + before - os.path.getsize(path)
+
+    archive_dir = os.path.join(OUTPUTS_DIR, ARCHIVE_DIR)
+    archives = sorted(os.listdir(archive_dir)) if os.path.isdir(archive_dir) else []
+    for name in archives:
+        if not name.endswith(".tar.gz"):
+            continue
+        path = os.path.join(archive_dir, name)
+        day = calendar.timegm(time.strptime(name[:-len(".tar.gz")], "%Y-%m-%d"))
+        if args.archive_days is not None and day + DAY < now - args.archive_days * DAY:
+            print(f"  {name}: deleted (older than {args.archive_days:g} days)")
+            if not args.dry_run:
+                freed += os.path.getsize(path)
+                os.remove(path)
+                runindex.forget_runs(OUTPUTS_DIR, day, day + DAY)
+        elif day + DAY < now - args.raw_days * DAY and has_raw(path):
+            print(f"  {name}: dropping resources.json (older than {args.raw_days:g} days)")
+            if not args.dry_run:
+                before = os.path.getsize(path)
+                rewrite_archive(path, keep_raw=False)
+                freed += before - os.path.getsize(path)
+
+    if args.dry_run:
+        print("\nDry run: nothing changed.")
+    else:
+        print(f"\nDone. Freed {freed / 1e6:.1f} MB.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Per-policy duration history for ordering and timing out custodian invocations.
+
+Each finished policy adds its ``execution.duration`` from metadata.json (or,
+for an invocation that timed out, the time it was allowed) to
+outputs/durations.json under its account/region/name key. The runner starts
+the longest units first and gives each invocation a timeout derived from the
+high percentile of its policies' recent durations.
+"""
+
+import json
+import os
+from common import OUTPUTS_DIR
+
+HISTORY_FILE = os.path.join(OUTPUTS_DIR, "durations.json")
+MAX_SAMPLES = 20          # most recent durations kept per policy
+TIMEOUT_PERCENTILE = 95
+TIMEOUT_FACTOR = 3        # headroom over the percentile
+STARTUP_ALLOWANCE = 30    # seconds for interpreter start, c7n import and session setup
+MIN_TIMEOUT = 60
+MAX_TIMEOUT = 1800
+
+
+def load_history():
+    if os.path.exists(HISTORY_FILE):
+        with open(HISTORY_FILE) as f:
+            return json.load(f)
+    return {}
+
+
+def save_history(history):
+    tmp = HISTORY_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(history, f, indent=2)
+    os.replace(tmp, HISTORY_FILE)
+
+
+def _key(account_id, region, name):
+    return f"{account_id}/{region}/{name}"
+
+
+def record(history, account_id, region, name, seconds):
+    samples = history.setdefault(_key(account_id, region, name), [])
+    samples.append(round(seconds, 3))
+    del samples[:-MAX_SAMPLES]
+
+
+def samples(history, account_id, region, name):
+    """Durations for one policy in one place, or those from everywhere it has run."""
+    found = history.get(_key(account_id, region, name))
+    if found:
+        return found
+    suffix = "/" + name
+    return [s for key, values in history.items() if key.endswith(suffix) for s in values]
+
+
+def percentile(values, q):
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def unit_cost(history, account_id, region, unit):
+    """Expected seconds for a unit, or None when any of its policies has no history."""
+    total = 0
+    for p in unit["policies"]:
+        found = samples(history, account_id, region, p["name"])
+        if not found:
+            return None
+        total += percentile(found, 50)
+    return total
+
+
+def longest_first(history, account_id, region, units):
+    """Order units by expected duration, longest first; units without history go first of all.
+
+    Starting the long ones early keeps a slow policy from being picked last
+    and stretching the run's tail.
+    """
+    def key(unit):
+        cost = unit_cost(history, account_id, region, unit)
+        return (cost is not None, -(cost or 0))
+    return sorted(units, key=key)
+
+
+def unit_timeout(history, account_id, region, unit, default):
+    """Timeout for one invocation; ``default`` until every policy in it has history."""
+    total = 0
+    for p in unit["policies"]:
+        found = samples(history, account_id, region, p["name"])
+        if not found:
+            return default
+        total += percentile(found, TIMEOUT_PERCENTILE)
+    return int(min(max(STARTUP_ALLOWANCE + TIMEOUT_FACTOR * total, MIN_TIMEOUT), MAX_TIMEOUT))
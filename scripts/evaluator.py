@@ -0,0 +1,284 @@
+"""Local evaluation of custodian value filters over a saved inventory snapshot.
+
+Policies whose filters are all value filters (``Key: value`` shorthand or
+``type: value``, with ``absent``/``present``/``empty``/``not-null`` and the
+usual operators) combined with ``and``/``or``/``not`` are compiled into
+filter trees. All policies on a resource type are evaluated together over
+its snapshot and write the same ``resources.json`` custodian would,
+``c7n:MatchedFilters`` included. Anything else raises Unsupported and is
+left to custodian.
+"""
+
+import fnmatch
+import json
+import operator
+import os
+import re
+import jmespath
+import runfiles
+from common import utc_iso
+
+ANNOTATION_KEY = "c7n:MatchedFilters"
+SPECIAL_VALUES = ("absent", "present", "not-null", "empty")
+BLOCKS = ("and", "or", "not")
+
+
+class Unsupported(ValueError):
+    """A filter the local evaluator cannot reproduce exactly."""
+
+
+def _glob(value, pattern):
+    return isinstance(value, str) and fnmatch.fnmatch(value, pattern)
+
+
+def _regex(value, pattern):
+    return isinstance(value, str) and re.match(pattern, value, flags=re.IGNORECASE) is not None
+
+
+def _regex_case(value, pattern):
+    return isinstance(value, str) and re.match(pattern, value) is not None
+
+
+# Same semantics as c7n.filters.core.OPERATORS.
+OPERATORS = {
+    "eq": operator.eq, "equal": operator.eq,
+    "ne": operator.ne, "not-equal": operator.ne,
+    "gt": operator.gt, "greater-than": operator.gt,
+    "ge": operator.ge, "gte": operator.ge,
+    "le": operator.le, "lte": operator.le,
+    "lt": operator.lt, "less-than": operator.lt,
+    "glob": _glob,
+    "regex": _regex,
+    "regex-case": _regex_case,
+    "in": lambda x, y: x in y,
+    "ni": lambda x, y: x not in y, "not-in": lambda x, y: x not in y,
+    "contains": operator.contains,
+    "difference": lambda x, y: bool(set(x).difference(y)),
+    "intersect": lambda x, y: bool(set(x).intersection(y)),
+}
+
+
+def _number(cast):
+    def convert(value):
+        try:
+            return cast(str(value).strip())
+        except ValueError:
+            return cast(0)
+    return convert
+
+
+def _size(value):
+    try:
+        return len(value)
+    except TypeError:
+        return 0
+
+
+# Conversions applied to the resource's value, as custodian's value_type does.
+VALUE_TYPES = {
+    "normalize": lambda v: v.strip().lower() if isinstance(v, str) else v,
+    "integer": _number(int),
+    "float": _number(float),
+    "size": _size,
+}
+
+
+class Values:
+    """Per-resource memo of looked-up keys, shared by every policy's predicates."""
+
+    _compiled = {}
+
+    def __init__(self, resource):
+        self.resource = resource
+        self.cache = {}
+
+    def get(self, key):
+        if key not in self.cache:
+            self.cache[key] = self._lookup(key)
+        return self.cache[key]
+
+    def _lookup(self, key):
+        r = self.resource
+        if key.startswith("tag:"):
+            tag_key = key.split(":", 1)[1]
+            for tag in r.get("Tags") or []:
+                if tag.get("Key") == tag_key:
+                    return tag.get("Value")
+            return None
+        if key in r:
+            return r[key]
+        if key not in self._compiled:
+            self._compiled[key] = jmespath.compile(key)
+        return self._compiled[key].search(r)
+
+
+def _compile_value(key, value, op=None, value_type=None):
+    if op is not None and op not in OPERATORS:
+        raise Unsupported(f"operator {op!r}")
+    if value_type is not None and value_type not in VALUE_TYPES:
+        raise Unsupported(f"value_type {value_type!r}")
+    compare = OPERATORS[op] if op else operator.eq
+    convert = VALUE_TYPES.get(value_type)
+
+    def match(values):
+        r = values.get(key)
+        if op in ("in", "not-in", "ni") and r is None:
+            r = ()
+        if convert is not None:
+            r = convert(r)
+        v = value
+        if isinstance(v, str) and v in SPECIAL_VALUES:
+            return ((v == "absent" and r is None) or (v == "present" and r is not None)
+                    or (v == "not-null" and bool(r)) or (v == "empty" and not r))
+        try:
+            return bool(compare(r, v))
+        except TypeError:
+            return False
+
+    return match
+
+
+def compile_filter(f, leaves):
+    """Compile one filter into a tree of ``("leaf", signature)`` and ``(block, children)`` nodes.
+
+    Each distinct value filter is registered once in ``leaves`` (signature ->
+    (key, match)), so a condition shared by many policies is evaluated once.
+    """
+    if not isinstance(f, dict):
+        raise Unsupported(f"filter {f!r}")
+    if len(f) == 1:
+        (key, value), = f.items()
+        if key in BLOCKS:
+            return (key, [compile_filter(c, leaves) for c in value])
+        if key != "type" and not isinstance(value, dict):
+            return _leaf(leaves, key, value)
+    if f.get("type") != "value":
+        raise Unsupported(f"filter type {f.get('type', next(iter(f)))!r}")
+    unknown = set(f) - {"type", "key", "value", "op", "value_type"}
+    if unknown:
+        raise Unsupported(f"value filter options {sorted(unknown)}")
+    return _leaf(leaves, f["key"], f.get("value"), f.get("op"), f.get("value_type"))
+
+
+def _leaf(leaves, key, value, op=None, value_type=None):
+    signature = json.dumps([key, value, op, value_type], sort_keys=True, default=str)
+    if signature not in leaves:
+        leaves[signature] = (key, _compile_value(key, value, op, value_type))
+    return ("leaf", signature)
+
+
+def compile_policy(policy_data, leaves):
+    """Tree for a policy's top-level filter list (an implicit and)."""
+    if policy_data.get("actions") or policy_data.get("query") or policy_data.get("mode"):
+        raise Unsupported("policies with actions, query or mode")
+    return ("and", [compile_filter(f, leaves) for f in policy_data.get("filters", [])])
+
+
+def supported(policy_data):
+    try:
+        compile_policy(policy_data, {})
+        return True
+    except Unsupported:
+        return False
+
+
+def load_snapshot(path):
+    """Read a snapshot file, which may have been compressed like any resources.json."""
+    found = runfiles.find_output(os.path.dirname(path), os.path.basename(path))
+    if found is None:
+        raise FileNotFoundError(f"no snapshot at {path}")
+    with runfiles.open_output(found) as f:
+        return json.load(f)
+
+
+def _combine(node, bits, everything, memo):
+    """Fold a filter tree into the bitset of resources it matches, noting every node's bitset in ``memo``."""
+    kind, arg = node
+    if kind == "leaf":
+        result = bits[arg]
+    else:
+        result = 0 if kind == "or" else everything
+        for child in arg:
+            if kind == "or":
+                result |= _combine(child, bits, everything, memo)
+            else:
+                result &= _combine(child, bits, everything, memo)
+        if kind == "not":
+            result = everything & ~result
+    memo[id(node)] = result
+    return result
+
+
+def _annotated(node, i, memo, out):
+    """Signatures of the leaves in resource ``i``'s ``c7n:MatchedFilters``, in order, repeats included.
+
+    Every matching leaf annotates, except inside a ``not`` or an ``and``
+    the resource fails: custodian sweeps those annotations away again.
+    """
+    kind, arg = node
+    if kind == "leaf":
+        if memo[id(node)] >> i & 1:
+            out.append(arg)
+    elif kind == "or" or (kind == "and" and memo[id(node)] >> i & 1):
+        for child in arg:
+            _annotated(child, i, memo, out)
+    return out
+
+
+def evaluate(policies, resources):
+    """Evaluate many policies over one resource list.
+
+    Every distinct value filter is evaluated once over all resources into a
+    bitset (bit i set when resource i matches), sharing each resource's
+    looked-up values; each policy is then just ``&``/``|``/``~`` over those
+    bitsets. Returns ``{policy name: [matched resources]}``. Matched
+    resources are shallow copies whose ``c7n:MatchedFilters`` lists the key
+    of every value filter they match, once per filter, as custodian's does:
+    filters inside a ``not``, or an ``and`` they fail, are left out (and any
+    annotation left over from whatever produced the snapshot is dropped).
+    """
+    leaves = {}
+    trees = [(p["name"], compile_policy(p, leaves)) for p in policies]
+    rows = [Values(r) for r in resources]
+    # Built from a bit string in one go; or-ing bits in one by one is quadratic.
+    bits = {
+        signature: int("".join("1" if match(values) else "0" for values in reversed(rows)) or "0", 2)
+        for signature, (key, match) in leaves.items()
+    }
+    everything = (1 << len(rows)) - 1
+
+    matched = {}
+    for name, tree in trees:
+        memo = {}
+        selected = _combine(tree, bits, everything, memo)
+        out = []
+        for i, bit in enumerate(reversed(bin(selected)[2:])):
+            if bit != "1":
+                continue
+            r = dict(resources[i])
+            r.pop(ANNOTATION_KEY, None)
+            keys = [leaves[sig][0] for sig in _annotated(tree, i, memo, [])]
+            if keys:
+                r[ANNOTATION_KEY] = keys
+            out.append(r)
+        matched[name] = out
+    return matched
+
+
+def write_outputs(policy_dir, policy_data, resources, start, end, region, account_id, snapshot):
+    """Write resources.json and metadata.json the way ``custodian run`` lays them out."""
+    os.makedirs(policy_dir, exist_ok=True)
+    with open(os.path.join(policy_dir, "resources.json"), "w") as f:
+        json.dump(resources, f, indent=2, default=str)
+    metadata = {
+        "policy": policy_data,
+        "version": "local",
+        "execution": {"start": start, "end_time": end, "duration": end - start},
+        "config": {"region": region, "account_id": account_id, "output_dir": os.path.dirname(policy_dir),
+                   "snapshot": snapshot},
+        "metrics": [{"MetricName": "ResourceCount", "Value": len(resources), "Unit": "Count",
+                     "Timestamp": utc_iso(end)}],
+    }
+    with open(os.path.join(policy_dir, "metadata.json"), "w") as f:
+        json.dump(metadata, f, indent=2, default=str)
+
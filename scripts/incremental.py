@@ -0,0 +1,147 @@
+"""Policy result reuse for incremental runs of 03_run_custodian.py.
+
+Each executed policy is recorded in outputs/incremental.json under its
+account/region/name key with a hash of its definition, a fingerprint of its
+resource type's inventory and where its outputs live. A later incremental run
+reuses those outputs instead of executing the policy again when nothing it
+depends on has visibly changed and the result is still fresh.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from common import OUTPUTS_DIR
+
+STORE_FILE = os.path.join(OUTPUTS_DIR, "incremental.json")
+
+
+def policy_hash(policy_data):
+    """Stable hash of a policy definition."""
+    return hashlib.sha256(json.dumps(policy_data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _digest(items):
+    return hashlib.sha256(json.dumps(sorted(items), default=str).encode()).hexdigest()
+
+
+def _s3_fingerprint(session):
+    buckets = session.client("s3").list_buckets()["Buckets"]
+    return _digest([[b["Name"], b["CreationDate"]] for b in buckets])
+
+
+def _ec2_fingerprint(session):
+    ec2 = session.client("ec2")
+    statuses = [
+        [s["InstanceId"], s["InstanceState"]["Name"]]
+        for page in ec2.get_paginator("describe_instance_status").paginate(IncludeAllInstances=True)
+        for s in page["InstanceStatuses"]
+    ]
+    tags = [
+        [t["ResourceId"], t["Key"], t["Value"]]
+        for page in ec2.get_paginator("describe_tags").paginate(
+            Filters=[{"Name": "resource-type", "Values": ["instance"]}])
+        for t in page["Tags"]
+    ]
+    return _digest(statuses + tags)
+
+
+def _ebs_fingerprint(session):
+    paginator = session.client("ec2").get_paginator("describe_volumes")
+    return _digest([
+        [v["VolumeId"], v["State"], v["Size"], sorted(a["InstanceId"] for a in v.get("Attachments", [])),
+         sorted([t["Key"], t["Value"]] for t in v.get("Tags", []))]
+        for page in paginator.paginate(PaginationConfig={"PageSize": 500})
+        for v in page["Volumes"]
+    ])
+
+
+# Cheap calls that change when a resource type's inventory does: one
+# ListBuckets for S3, instance ids, states and tags for EC2, and volume ids,
+# states, sizes, attachments and tags for EBS. Policies on other types are
+# executed every time unless reuse without a fingerprint is asked for.
+FINGERPRINTS = {
+    "s3": _s3_fingerprint,
+    "ec2": _ec2_fingerprint,
+    "ebs": _ebs_fingerprint,
+}
+
+
+def inventory_fingerprints(session, resource_types):
+    """Fingerprint each resource type that has a fingerprint function.
+
+    A type whose fingerprint call fails maps to ``"unavailable"``, which never
+    matches a stored fingerprint, so its policies are executed.
+    """
+    fingerprints = {}
+    for rtype in sorted(set(resource_types)):
+        fn = FINGERPRINTS.get(rtype)
+        if fn is None:
+            continue
+        try:
+            fingerprints[rtype] = fn(session)
+        except Exception:
+            fingerprints[rtype] = "unavailable"
+    return fingerprints
+
+
+def load_store():
+    if os.path.exists(STORE_FILE):
+        with open(STORE_FILE) as f:
+            return json.load(f)
+    return {}
+
+
+def save_store(store):
+    tmp = STORE_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(store, f, indent=2)
+    os.replace(tmp, STORE_FILE)
+
+
+def store_key(account_id, region, name):
+    return f"{account_id}/{region}/{name}"
+
+
+def reusable(record, policy, fingerprints, max_age, unfingerprinted=False):
+    """Whether a stored record can stand in for running ``policy`` now.
+
+    Policies on a type without a fingerprint are only reused with
+    ``unfingerprinted``, on their hash and freshness alone.
+    """
+    if not record or record.get("status") != "ok":
+        return False
+    if policy["resource"] not in FINGERPRINTS and not unfingerprinted:
+        return False
+    if record["hash"] != policy_hash(policy["data"]):
+        return False
+    if time.time() - record["observed_at"] > max_age:
+        return False
+    if record.get("fingerprint") != fingerprints.get(policy["resource"]):
+        return False
+    return os.path.isdir(os.path.join(OUTPUTS_DIR, record["path"]))
+
+
+def reuse_outputs(record, dest_dir):
+    """Link (or copy, across filesystems) a previous policy output directory into this run."""
+    src_dir = os.path.join(OUTPUTS_DIR, record["path"])
+    os.makedirs(dest_dir, exist_ok=True)
+    for name in os.listdir(src_dir):
+        src, dest = os.path.join(src_dir, name), os.path.join(dest_dir, name)
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)
+
+
+def make_record(run_id, policy, result, policy_dir, fingerprints, observed_at):
+    """Record an executed policy; freshness is measured from ``observed_at`` (the run start)."""
+    return {
+        "hash": policy_hash(policy["data"]),
+        "fingerprint": fingerprints.get(policy["resource"]),
+        "run_id": run_id,
+        "path": os.path.relpath(policy_dir, OUTPUTS_DIR),
+        "status": result["status"],
+        "observed_at": observed_at,
+    }
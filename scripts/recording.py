@@ -0,0 +1,102 @@
+"""Record and replay the AWS API responses of in-process runs with placebo.
+
+A recording directory holds one placebo response directory per account and
+region, plus recording.json describing what was recorded, so a replay needs
+neither credentials nor network access.
+"""
+
+import json
+import os
+import shutil
+import boto3
+from common import utc_iso
+
+INDEX_FILE = "recording.json"
+
+
+def target_dir(root, account_id, region):
+    return os.path.join(root, account_id, region)
+
+
+def has_recording(root):
+    """Whether ``root`` already holds files; placebo would number new responses after the old ones."""
+    return os.path.isdir(root) and bool(os.listdir(root))
+
+
+def clear(root):
+    shutil.rmtree(root, ignore_errors=True)
+
+
+def write_index(root, accounts, regions, per_account, per_region):
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, INDEX_FILE), "w") as f:
+        json.dump({
+            "recorded_at": utc_iso(),
+            "accounts": [{"account_id": a["account_id"], "name": a["name"]} for a in accounts],
+            "regions": regions,
+            "per_account": per_account,
+            "per_region": per_region,
+        }, f, indent=2)
+
+
+def read_index(root):
+    path = os.path.join(root, INDEX_FILE)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{INDEX_FILE} not found in {root}")
+    with open(path) as f:
+        return json.load(f)
+
+
+def serialize_c7n():
+    """Run c7n's internal thread pools inline.
+
+    placebo numbers responses per operation in call order, so a replay only
+    matches its recording when both make their calls in the same order.
+    """
+    from c7n.element import Element
+    from c7n.executor import MainThreadExecutor
+    from c7n.manager import ResourceManager
+
+    Element.executor_factory = MainThreadExecutor
+    ResourceManager.executor_factory = MainThreadExecutor
+
+
+def session_factory(mode, path, region, credentials=None):
+    """A c7n session factory whose single boto3 session records to or replays from ``path``.
+
+    Every policy in the target shares the session, and so one placebo pill
+    and one response sequence.
+    """
+    import placebo
+    from c7n.credentials import SessionFactory
+
+    if mode == "replay":
+        # Responses come from disk before any request is signed.
+        session = boto3.Session(region_name=region, aws_access_key_id="replay",
+                                aws_secret_access_key="replay")
+    elif credentials:
+        session = credentials.session(region)
+    else:
+        session = boto3.Session(region_name=region)
+    os.makedirs(path, exist_ok=True)
+    pill = placebo.attach(session, data_path=path)
+    if mode == "replay":
+        load_response = pill.load_response
+
+        def replay_response(service, operation):
+            # botocore's GetBucketLocation parser reads http_response.raw, which
+            # placebo's stand-in response lacks; None makes it keep the parsed data.
+            response, data = load_response(service, operation)
+            response.raw = None
+            return response, data
+
+        pill.load_response = replay_response
+        pill.playback()
+    else:
+        pill.record()
+
+    class PlaceboSessionFactory(SessionFactory):
+        def __call__(self, assume=True, region=None):
+            return self.update(session)
+
+    return PlaceboSessionFactory(region)
@@ -0,0 +1,292 @@
+"""Readers for custodian run directories written by 03_run_custodian.py.
+
+Kept free of third-party imports so the CoreStack ingest can share it;
+zstandard is only imported when a ``.zst`` file is written or read, and
+c7n (where installed) only to look up a resource type's id field.
+"""
+
+import functools
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import tarfile
+import time
+
+# --compress method -> suffix added to the compressed file's name.
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+DIGEST_FILE = "digest.json"
+DIGEST_MAX_IDS = 1000  # resource ids listed per policy; larger outputs keep only the hash
+# Bumped whenever resource_id changes, so ids digested the old way are not compared with new ones.
+DIGEST_IDS_VERSION = 2
+# Identifier keys tried in order when custodian's id field for a type is unknown or missing.
+ID_FALLBACKS = ("InstanceId", "VolumeId", "GroupId", "DBInstanceIdentifier", "FunctionName",
+                "ResourceId", "Id", "Arn", "Name")
+
+# Compacted runs live in one archive per UTC day under <outputs>/archive/.
+ARCHIVE_DIR = "archive"
+RUN_ID = re.compile(r"^run-(\d+)$")
+
+
+def policy_outputs(manifest, run_dir):
+    """List the per-policy output directories of a run.
+
+    Older manifests only list policy names, laid out directly under the run
+    directory. Newer ones (with a ``complete`` flag) carry one result per
+    policy, account and region with its ``output_path`` relative to the run
+    directory; a run still in progress lists only the units finished so far.
+    Paths are always resolved against ``run_dir``, since the manifest's own
+    ``output_dir`` is absolute on the host that produced it.
+    """
+    results = [r for r in manifest.get("results", []) if "output_path" in r]
+    if results or "complete" in manifest:
+        return [
+            {
+                "name": r["name"],
+                "account_id": r.get("account_id", manifest["account_id"]),
+                "region": r["region"],
+                "path": os.path.join(run_dir, r["output_path"]),
+                "result": r,
+            }
+            for r in results
+        ]
+    return [
+        {
+            "name": name,
+            "account_id": manifest["account_id"],
+            "region": manifest["region"],
+            "path": os.path.join(run_dir, name),
+            "result": None,
+        }
+        for name in manifest.get("policies_run", [])
+    ]
+
+
+def find_output(policy_dir, name):
+    """Path of an output file as written, plain or compressed, or None."""
+    for suffix in ("",) + tuple(COMPRESSIONS.values()):
+        path = os.path.join(policy_dir, name + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def open_output(path):
+    """Open an output file for reading as text, decompressing by its suffix."""
+    if path.endswith(COMPRESSIONS["gzip"]):
+        return gzip.open(path, "rt")
+    if path.endswith(COMPRESSIONS["zstd"]):
+        import zstandard
+        return zstandard.open(path, "rt")
+    return open(path)
+
+
+def iter_json_array(f, chunk_size=1 << 16):
+    """Yield the items of a top-level JSON array from a text file, one at a time.
+
+    Only the item being decoded and one chunk are held in memory, so a
+    multi-GB resources.json is read in constant memory.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def more():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
+    def next_char():
+        # Skip whitespace, reading on as needed; "" at the end of the file.
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            more()
+
+    if next_char() != "[":
+        raise ValueError("expected a JSON array")
+    pos += 1
+    if next_char() == "]":
+        return
+    while True:
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                more()
+                continue
+            # Only a delimiter after an item proves it complete: a number cut
+            # at the end of a chunk ("3." of "3.5") still decodes.
+            if eof or (end < len(buf) and buf[end] in ",] \t\r\n"):
+                break
+            more()
+        pos = end
+        yield item
+        c = next_char()
+        if c == "]":
+            return
+        if c != ",":
+            raise ValueError(f"expected ',' or ']' in JSON array, got {c!r}")
+        pos += 1
+        next_char()
+
+
+def iter_resources(policy_dir):
+    """Stream the resources in a policy's resources.json (plain or compressed); nothing if it has none."""
+    path = find_output(policy_dir, "resources.json")
+    if path is None:
+        return
+    with open_output(path) as f:
+        yield from iter_json_array(f)
+
+
+def count_resources(policy_dir):
+    """Number of resources in a policy's resources.json, or None without one, in constant memory."""
+    if find_output(policy_dir, "resources.json") is None:
+        return None
+    return sum(1 for _ in iter_resources(policy_dir))
+
+
+def read_json(policy_dir, name, default=None):
+    """Load a policy's JSON output (e.g. resources.json) whether or not it was compressed."""
+    path = find_output(policy_dir, name)
+    if path is None:
+        return default
+    with open_output(path) as f:
+        return json.load(f)
+
+
+def resource_count(metadata):
+    """The ResourceCount metric custodian records in metadata.json (0 without one)."""
+    for metric in (metadata or {}).get("metrics", []):
+        if metric.get("MetricName") == "ResourceCount":
+            return int(metric.get("Value", 0))
+    return 0
+
+
+def output_resource_type(output):
+    """Resource type of a policy output: from its result, or its metadata.json for older runners' manifests."""
+    return ((output["result"] or {}).get("resource")
+            or (read_json(output["path"], "metadata.json") or {}).get("policy", {}).get("resource", ""))
+
+
+@functools.lru_cache(maxsize=None)
+def id_field(resource_type):
+    """The id field custodian declares for a resource type (``ec2``/``aws.ec2``), or None without c7n."""
+    name = resource_type if "." in resource_type else f"aws.{resource_type}"
+    try:
+        from c7n.provider import get_resource_class
+        from c7n.resources import load_resources
+        load_resources((name,))
+        return get_resource_class(name).resource_type.id
+    except (ImportError, KeyError):
+        return None
+
+
+def resource_id(resource, resource_type):
+    """A resource's identifier, shared by digests, diffs and the ingest."""
+    key = id_field(resource_type) if resource_type else None
+    if key in resource:
+        return str(resource[key])
+    for key in ID_FALLBACKS:
+        if key in resource:
+            return str(resource[key])
+    return "unknown"
+
+
+def digest_entry(policy_dir, resource_type):
+    """Summarise one policy's outputs: violation count, resource ids, duration and API call stats.
+
+    ``violations`` is None when the policy wrote no resources.json.
+    """
+    found = find_output(policy_dir, "resources.json") is not None
+    metadata = read_json(policy_dir, "metadata.json") or {}
+    ids = sorted(resource_id(r, resource_type) for r in iter_resources(policy_dir))
+    entry = {
+        "violations": len(ids) if found else None,
+        "ids_sha256": hashlib.sha256("\n".join(ids).encode()).hexdigest(),
+        "duration": metadata.get("execution", {}).get("duration"),
+        "api_stats": metadata.get("api-stats", {}),
+    }
+    if len(ids) <= DIGEST_MAX_IDS:
+        entry["resource_ids"] = ids
+    return entry
+
+
+def read_digest(run_dir):
+    """A run's digest.json keyed by output path, or None for runs written without one."""
+    path = os.path.join(run_dir, DIGEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        digest = json.load(f)
+    if digest.get("ids_version") != DIGEST_IDS_VERSION:
+        # Older runners digested the ids of types other than s3/ec2/ebs as "unknown". Those, and
+        # hashes with no ids to check, are left out, so callers read the ids from resources.json.
+        for entry in digest["policies"].values():
+            if "unknown" in entry.get("resource_ids", ["unknown"]):
+                entry.pop("resource_ids", None)
+                entry.pop("ids_sha256", None)
+    return digest["policies"]
+
+
+def compress_output(path, method):
+    """Replace ``path`` with a compressed copy; the original is removed only once the copy is complete."""
+    target = path + COMPRESSIONS[method]
+    tmp = target + ".tmp"
+    with open(path, "rb") as src:
+        if method == "zstd":
+            import zstandard
+            with open(tmp, "wb") as dst:
+                zstandard.ZstdCompressor(level=3).copy_stream(src, dst)
+        else:
+            with gzip.open(tmp, "wb", compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(tmp, target)
+    os.remove(path)
+    return target
+
+
+def run_time(run_id):
+    """Epoch a run started at, from its ``run-<epoch>`` id, or None for other names."""
+    m = RUN_ID.match(run_id)
+    return int(m.group(1)) if m else None
+
+
+def archive_path(outputs_dir, run_id):
+    """The day archive a run is compacted into."""
+    day = time.strftime("%Y-%m-%d", time.gmtime(run_time(run_id)))
+    return os.path.join(outputs_dir, ARCHIVE_DIR, f"{day}.tar.gz")
+
+
+def archived_run(run_dir):
+    """Archive holding a compacted run, given the directory the run used to have, or None."""
+    run_dir = os.path.normpath(run_dir)
+    run_id = os.path.basename(run_dir)
+    if run_time(run_id) is None:
+        return None
+    path = archive_path(os.path.dirname(run_dir), run_id)
+    if not os.path.exists(path):
+        return None
+    with tarfile.open(path, "r:gz") as tar:
+        names = tar.getnames()
+    return path if f"{run_id}/manifest.json" in names else None
+
+
+def extract_run(archive, run_id, dest):
+    """Unpack one run from a day archive into ``dest`` and return its directory there."""
+    prefix = run_id + "/"
+    with tarfile.open(archive, "r:gz") as tar:
+        members = [m for m in tar.getmembers() if m.name.startswith(prefix) and m.isfile()]
+        # The "data" filter (where this Python has it) refuses links and paths outside dest.
+        extra = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+        tar.extractall(dest, members=members, **extra)
+    return os.path.join(dest, run_id)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Catalogue of runs in outputs/index.db, so tools find runs without listing directories.
+
+The runner records each run when it starts, at every manifest checkpoint
+and when it finishes, with one row per policy, account and region finished
+so far giving its status, duration and resource count (from metadata.json). compact_outputs.py marks archived runs
+and forgets deleted ones. Kept free of third-party imports so the CoreStack
+ingest can share it. Run as a script, ``--rebuild`` indexes the run
+directories already under outputs/.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from runfiles import policy_outputs, read_digest, read_json, resource_count, run_time
+
+INDEX_FILE = "index.db"
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        run_id      TEXT PRIMARY KEY,
+        started     REAL NOT NULL,
+        timestamp   TEXT NOT NULL,
+        complete    INTEGER NOT NULL,
+        account_id  TEXT NOT NULL,
+        region      TEXT NOT NULL,
+        engine      TEXT,
+        policies    INTEGER NOT NULL,
+        ok          INTEGER NOT NULL,
+        errors      INTEGER NOT NULL,
+        violations  INTEGER NOT NULL,
+        duration    REAL NOT NULL,
+        location    TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+
+    CREATE TABLE IF NOT EXISTS policy_results (
+        run_id      TEXT NOT NULL,
+        account_id  TEXT NOT NULL,
+        region      TEXT NOT NULL,
+        name        TEXT NOT NULL,
+        status      TEXT NOT NULL,
+        violations  INTEGER,
+        duration    REAL,
+        PRIMARY KEY (run_id, account_id, region, name)
+    );
+    CREATE INDEX IF NOT EXISTS policy_results_name ON policy_results (name, run_id);
+"""
+
+
+def connect(outputs_dir):
+    conn = sqlite3.connect(os.path.join(outputs_dir, INDEX_FILE), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def record_run(outputs_dir, manifest, run_dir):
+    """Add or refresh a run from its manifest and digest.json (or, without one, each policy's metadata.json)."""
+    digest = read_digest(run_dir) or {}
+    rows = []
+    for output in policy_outputs(manifest, run_dir):
+        result = output["result"] or {}
+        entry = digest.get(os.path.relpath(output["path"], run_dir))
+        if entry is not None:
+            status, violations = entry["status"], entry["violations"]
+        else:
+            metadata = read_json(output["path"], "metadata.json")
+            status = result.get("status", "ok" if metadata else "error")
+            violations = resource_count(metadata) if metadata else None
+        rows.append((manifest["run_id"], output["account_id"], output["region"], output["name"],
+                     status, violations, result.get("duration")))
+    run_id = manifest["run_id"]
+    started = run_time(run_id) or os.path.getmtime(os.path.join(run_dir, "manifest.json"))
+    ok = sum(1 for r in rows if r[4] == "ok")
+    conn = connect(outputs_dir)
+    with conn:
+        conn.execute("DELETE FROM policy_results WHERE run_id = ?", (run_id,))
+        conn.executemany("INSERT INTO policy_results VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+            run_id, started, manifest["timestamp"], int(manifest.get("complete", True)),
+            manifest["account_id"], manifest["region"], manifest.get("engine"),
+            len(rows), ok, len(rows) - ok, sum(r[5] or 0 for r in rows),
+            round(sum(r[6] or 0 for r in rows), 3), os.path.relpath(run_dir, outputs_dir),
+        ))
+    conn.close()
+
+
+def set_location(outputs_dir, run_ids, location):
+    """Point runs at where they now live (e.g. a day archive), relative to outputs/."""
+    conn = connect(outputs_dir)
+    with conn:
+        conn.executemany("UPDATE runs SET location = ? WHERE run_id = ?", [(location, r) for r in run_ids])
+    conn.close()
+
+
+def forget_runs(outputs_dir, start, end):
+    """Drop the runs started in [start, end) from the index."""
+    conn = connect(outputs_dir)
+    with conn:
+        conn.execute("DELETE FROM policy_results WHERE run_id IN "
+                     "(SELECT run_id FROM runs WHERE started >= ? AND started < ?)", (start, end))
+        conn.execute("DELETE FROM runs WHERE started >= ? AND started < ?", (start, end))
+    conn.close()
+
+
+def list_runs(outputs_dir, limit=None, since=None, complete=None):
+    """Indexed runs, newest first."""
+    if not os.path.exists(os.path.join(outputs_dir, INDEX_FILE)):
+        return []
+    query, params = "SELECT * FROM runs WHERE 1 = 1", []
+    if since is not None:
+        query += " AND started >= ?"
+        params.append(since)
+    if complete is not None:
+        query += " AND complete = ?"
+        params.append(int(complete))
+    query += " ORDER BY started DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    conn = connect(outputs_dir)
+    runs = [dict(r) for r in conn.execute(query, params)]
+    conn.close()
+    return runs
+
+
+def latest_run(outputs_dir):
+    runs = list_runs(outputs_dir, limit=1)
+    return runs[0] if runs else None
+
+
+def run_dir(outputs_dir, run):
+    """Directory of an indexed run: archived runs are addressed by the path they were compacted from."""
+    return os.path.join(outputs_dir, run["run_id"])
+
+
+def policy_results(outputs_dir, run_id):
+    conn = connect(outputs_dir)
+    rows = [dict(r) for r in conn.execute(
+        "SELECT * FROM policy_results WHERE run_id = ? ORDER BY account_id, region, name", (run_id,))]
+    conn.close()
+    return rows
+
+
+def rebuild(outputs_dir):
+    """Index every run directory under outputs/ (archived runs keep whatever entry they had)."""
+    count = 0
+    for name in sorted(os.listdir(outputs_dir)):
+        path = os.path.join(outputs_dir, name, "manifest.json")
+        if run_time(name) is None or not os.path.exists(path):
+            continue
+        with open(path) as f:
+            record_run(outputs_dir, json.load(f), os.path.join(outputs_dir, name))
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rebuild", action="store_true", help="index every run directory under outputs/")
+    parser.add_argument("--limit", type=int, default=20, help="runs to list (default: 20)")
+    args = parser.parse_args()
+
+    from common import OUTPUTS_DIR
+    if args.rebuild:
+        print(f"Indexed {rebuild(OUTPUTS_DIR)} runs into {os.path.join(OUTPUTS_DIR, INDEX_FILE)}")
+        return
+    runs = list_runs(OUTPUTS_DIR, limit=args.limit)
+    if not runs:
+        print("No runs indexed. Run with --rebuild to index existing run directories.")
+        sys.exit(1)
+    for run in runs:
+        print(f"{run['run_id']:18s} {run['timestamp']}  {run['ok']:3d} ok {run['errors']:3d} error "
+              f"{run['violations']:5d} resources  {'complete' if run['complete'] else 'incomplete':10s} "
+              f"{run['location']}")
+
+
+if __name__ == "__main__":
+    main()
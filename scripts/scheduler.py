@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Run custodian policies continuously, each on its own interval.
+
+A policy's interval comes from a ``schedule:<duration>`` tag (e.g.
+``schedule:30m``) or else from its ``severity:`` tag. Every due policy is
+run as one batch through 03_run_custodian.py, which writes the usual run
+directory and manifest. Options the scheduler does not know are passed
+through to the runner (e.g. --regions, --engine api).
+"""
+
+import argparse
+import glob
+import os
+import random
+import subprocess
+import sys
+import time
+import yaml
+from common import load_state, utc_iso, POLICIES_DIR
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "03_run_custodian.py")
+CORESTACK_DIR = os.environ.get(
+    "CORESTACK_INTEGRATION", os.path.join(os.path.dirname(__file__), "..", "corestack-integration-mock"))
+
+SEVERITY_INTERVALS = {
+    "critical": 15 * 60,
+    "high": 15 * 60,
+    "medium": 60 * 60,
+    "low": 6 * 60 * 60,
+}
+DEFAULT_INTERVAL = 60 * 60
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="custodian invocations running at once across the whole batch (default: 4)")
+    parser.add_argument("--jitter", type=float, default=0.1,
+                        help="randomise each interval by up to this fraction (default: 0.1)")
+    parser.add_argument("--tick", type=int, default=30,
+                        help="longest sleep between checks for due policies, in seconds (default: 30)")
+    parser.add_argument("--ingest", action="store_true",
+                        help="ingest each finished run into the CoreStack mock database")
+    parser.add_argument("--once", action="store_true",
+                        help="run the policies that are due now, then exit")
+    return parser.parse_known_args()
+
+
+def parse_duration(value):
+    """'90s', '15m', '6h', '1d' or plain seconds -> seconds."""
+    value = value.strip().lower()
+    if value[-1:] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+def policy_interval(policy):
+    tags = [t for t in policy.get("tags", []) if isinstance(t, str)]
+    for tag in tags:
+        if tag.startswith("schedule:"):
+            return parse_duration(tag.split(":", 1)[1])
+    for tag in tags:
+        if tag.startswith("severity:"):
+            return SEVERITY_INTERVALS.get(tag.split(":", 1)[1].lower(), DEFAULT_INTERVAL)
+    return DEFAULT_INTERVAL
+
+
+def load_intervals():
+    """Map every policy in policies/ to its interval; re-read each cycle to pick up regenerated packs."""
+    intervals = {}
+    for pf in sorted(glob.glob(os.path.join(POLICIES_DIR, "*.yml"))):
+        with open(pf) as f:
+            for policy in (yaml.safe_load(f) or {}).get("policies", []):
+                intervals[policy["name"]] = policy_interval(policy)
+    return intervals
+
+
+def jittered(interval, jitter):
+    return interval * (1 + random.uniform(-jitter, jitter))
+
+
+def run_batch(names, concurrency, runner_args):
+    """Run one batch through the runner and return its run directory (None if none was started)."""
+    before = load_state().get("last_run_output_dir")
+    # One region and account at a time, so --concurrency bounds the whole
+    # batch; runner options passed through come later and win.
+    cmd = [sys.executable, RUNNER, "--policies", ",".join(names), "--workers", str(concurrency),
+           "--region-workers", "1", "--account-workers", "1"] + runner_args
+    rc = subprocess.run(cmd).returncode
+    if rc != 0:
+        print(f"[{utc_iso()}] runner exited with {rc}")
+    run_dir = load_state().get("last_run_output_dir")
+    return run_dir if run_dir != before else None
+
+
+def main():
+    args, runner_args = parse_args()
+    concurrency = max(1, args.concurrency)
+
+    ingest = None
+    if args.ingest:
+        sys.path.insert(0, CORESTACK_DIR)
+        from integration import store, ingest, seed_corestack
+        store.init_db()
+        seed_corestack.seed()
+
+    next_due = {}
+    try:
+        while True:
+            intervals = load_intervals()
+            if not intervals:
+                print("ERROR: No policy YAML files found in policies/. Run 02_generate_policies.py first.")
+                sys.exit(1)
+            now = time.time()
+            due = [name for name in intervals if next_due.setdefault(name, now) <= now]
+
+            if due:
+                print(f"[{utc_iso()}] Running {len(due)} due policies: {', '.join(due)}")
+                run_dir = run_batch(due, concurrency, runner_args)
+                finished = time.time()
+                for name in due:
+                    next_due[name] = finished + jittered(intervals[name], args.jitter)
+                if run_dir and ingest:
+                    try:
+                        result = ingest.ingest_run(run_dir)
+                        print(f"[{utc_iso()}] Ingested {result['run_id']}: "
+                              f"{result['findings_ingested']} findings, {result['resources_ingested']} resources")
+                    except Exception as e:
+                        print(f"[{utc_iso()}] Ingest of {run_dir} failed: {e}")
+                print(f"[{utc_iso()}] Next policy due at {utc_iso(min(next_due[n] for n in intervals))}")
+
+            if args.once:
+                break
+            wake = min(next_due[name] for name in intervals)
+            time.sleep(min(max(wake - time.time(), 1), args.tick))
+    except KeyboardInterrupt:
+        print("\nScheduler stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Throttling-aware rate limiting and retry for concurrent policy runs.
+
+All workers of a run share one token bucket per AWS service. The bucket
+halves its rate whenever throttling is seen and creeps back up after clean
+work (AIMD), so concurrency settles at what the account sustains. boto3
+clients use botocore's adaptive retry mode, and units that still fail with
+throttling are retried after a jittered backoff.
+"""
+
+import os
+import random
+import threading
+import time
+
+THROTTLE_CODES = (
+    "Throttling", "ThrottlingException", "RequestLimitExceeded", "SlowDown",
+    "TooManyRequestsException", "RequestThrottled", "Throttled",
+)
+# Substrings that mark a throttled call in custodian's console output.
+THROTTLE_MARKERS = THROTTLE_CODES + ("Rate exceeded",)
+
+# Resource types whose API lives in a differently named service.
+RESOURCE_SERVICES = {
+    "ebs": "ec2",
+    "ebs-snapshot": "ec2",
+    "ami": "ec2",
+    "security-group": "ec2",
+    "vpc": "ec2",
+    "subnet": "ec2",
+    "eni": "ec2",
+}
+
+MAX_REQUEUES = 3
+BACKOFF_BASE = 5   # seconds; doubled per attempt, full jitter
+BACKOFF_CAP = 60
+MAX_ATTEMPTS = "10"  # botocore attempts per API call in adaptive mode
+
+
+def service_for(resource_type):
+    return RESOURCE_SERVICES.get(resource_type, resource_type)
+
+
+def is_throttle(text):
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+
+def backoff(attempt):
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def configure_retries(environ=os.environ):
+    """Use botocore's adaptive retry mode (client-side rate limiting) unless configured otherwise.
+
+    Set in the runner's own environment, this reaches in-process clients and
+    every custodian child process alike.
+    """
+    environ.setdefault("AWS_RETRY_MODE", "adaptive")
+    environ.setdefault("AWS_MAX_ATTEMPTS", MAX_ATTEMPTS)
+
+
+class TokenBucket:
+    """Token bucket whose rate adapts: halved on throttling, raised a step after success."""
+
+    def __init__(self, rate, min_rate=0.1):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def feedback(self, throttled):
+        with self._lock:
+            if throttled:
+                self.rate = max(self.min_rate, self.rate / 2)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class Throttle:
+    """Per-service buckets and throttle statistics shared by one run.
+
+    ``rate`` is the per-service ceiling: API calls per second in-process,
+    custodian invocations started per second for the CLI engine. Without a
+    rate nothing is limited, but throttling is still counted and retried.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.buckets = {}
+        self.events = {}
+        self.requeued = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, service):
+        with self._lock:
+            if service not in self.buckets:
+                self.buckets[service] = TokenBucket(self.rate)
+            return self.buckets[service]
+
+    def acquire(self, service):
+        if self.rate:
+            self.bucket(service).acquire()
+
+    def feedback(self, service, throttled):
+        if self.rate:
+            self.bucket(service).feedback(throttled)
+
+    def record(self, service, count=1):
+        with self._lock:
+            self.events[service] = self.events.get(service, 0) + count
+
+    def record_requeue(self, service):
+        with self._lock:
+            self.requeued[service] = self.requeued.get(service, 0) + 1
+
+    def session_hook(self, counter):
+        """A session hook limiting every API call and counting throttled attempts.
+
+        ``counter`` is called with the service name for each throttled attempt.
+        """
+        def before_call(model, **kwargs):
+            self.acquire(model.service_model.endpoint_prefix)
+
+        def needs_retry(response, operation, **kwargs):
+            if response is None:
+                return None
+            code = response[1].get("Error", {}).get("Code", "")
+            service = operation.service_model.endpoint_prefix
+            throttled = code in THROTTLE_CODES
+            self.feedback(service, throttled)
+            if throttled:
+                self.record(service)
+                counter(service)
+            return None
+
+        def subscribe(session):
+            events = session._session.get_component("event_emitter")
+            events.register("before-call", before_call, unique_id="runner-throttle-acquire")
+            events.register("needs-retry", needs_retry, unique_id="runner-throttle-count")
+
+        return subscribe
+
+    def attach(self, session_factory, counter):
+        """Hook every session ``session_factory`` hands out.
+
+        c7n replaces a factory's subscribers around each policy run (for its
+        API call stats), so the hook wraps ``update`` rather than subscribing.
+        """
+        hook = self.session_hook(counter)
+        update = session_factory.update
+
+        def hooked(session):
+            session = update(session)
+            hook(session)
+            return session
+
+        session_factory.update = hooked
+
+    def summary(self):
+        with self._lock:
+            summary = {
+                "events": sum(self.events.values()),
+                "requeued": sum(self.requeued.values()),
+                "by_service": {
+                    s: {"events": self.events.get(s, 0), "requeued": self.requeued.get(s, 0)}
+                    for s in sorted(set(self.events) | set(self.requeued))
+                },
+            }
+            if self.rate:
+                summary["rates"] = {s: round(b.rate, 3) for s, b in sorted(self.buckets.items())}
+            return summary
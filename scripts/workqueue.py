@@ -0,0 +1,191 @@
+"""SQLite lease queue sharing one run's units between runner processes.
+
+The coordinator enqueues every (account, region) unit of a run into
+``<run>/queue.db``. Any runner joined to the run claims units with a lease,
+renews the leases while it works and stores each unit's results back in the
+queue. A unit whose lease runs out (its worker died or lost the storage) can
+be claimed again. The database must live on storage with working file locks
+shared by every worker, as the run directory already is.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+QUEUE_FILE = "queue.db"
+LEASE_SECONDS = 120
+RENEW_INTERVAL = 30
+POLL_INTERVAL = 5
+UNKNOWN_COST = 1e9  # units without duration history are claimed first
+
+
+def worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """Units of one run and who holds them.
+
+    Every call opens its own connection, so one queue can be shared by all
+    of a runner's threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @classmethod
+    def create(cls, path, spec):
+        """Start an empty queue for a run; ``spec`` tells joining runners how to run its units."""
+        if os.path.exists(path):
+            os.remove(path)
+        queue = cls(path)
+        conn = queue._connect()
+        conn.executescript("""
+            CREATE TABLE spec (
+                data TEXT NOT NULL
+            );
+            CREATE TABLE units (
+                id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                account_id    TEXT NOT NULL,
+                region        TEXT NOT NULL,
+                unit_json     TEXT NOT NULL,
+                priority      REAL NOT NULL,
+                status        TEXT NOT NULL DEFAULT 'pending',
+                worker        TEXT,
+                lease_expires REAL,
+                attempts      INTEGER NOT NULL DEFAULT 0,
+                results_json  TEXT
+            );
+            CREATE TABLE workers (
+                worker      TEXT PRIMARY KEY,
+                units       INTEGER NOT NULL DEFAULT 0,
+                last_seen   REAL NOT NULL,
+                throttling  TEXT
+            );
+        """)
+        conn.execute("INSERT INTO spec (data) VALUES (?)", (json.dumps(spec),))
+        conn.close()
+        return queue
+
+    @classmethod
+    def open(cls, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"no work queue at {path}")
+        return cls(path)
+
+    def spec(self):
+        conn = self._connect()
+        row = conn.execute("SELECT data FROM spec").fetchone()
+        conn.close()
+        return json.loads(row["data"])
+
+    def enqueue(self, account_id, region, units, priorities):
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO units (account_id, region, unit_json, priority) VALUES (?, ?, ?, ?)",
+                [(account_id, region, json.dumps(u, default=str), p) for u, p in zip(units, priorities)])
+        conn.close()
+
+    def claim(self, worker):
+        """Lease the most expensive unit that is pending or whose lease ran out, or return None."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("""
+                SELECT * FROM units
+                WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?)
+                ORDER BY priority DESC, id LIMIT 1
+            """, (now,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE units SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE id = ?", (worker, now + LEASE_SECONDS, row["id"]))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return {"id": row["id"], "account_id": row["account_id"], "region": row["region"],
+                "attempts": row["attempts"] + 1, "unit": json.loads(row["unit_json"])}
+
+    def renew(self, worker):
+        """Extend every lease ``worker`` holds."""
+        conn = self._connect()
+        with conn:
+            conn.execute("UPDATE units SET lease_expires = ? WHERE status = 'leased' AND worker = ?",
+                         (time.time() + LEASE_SECONDS, worker))
+        conn.close()
+
+    def complete(self, unit_id, worker, results):
+        """Store a unit's results; the first worker to finish a unit wins."""
+        conn = self._connect()
+        with conn:
+            cur = conn.execute(
+                "UPDATE units SET status = 'done', worker = ?, results_json = ? WHERE id = ? AND status != 'done'",
+                (worker, json.dumps(results, default=str), unit_id))
+            if cur.rowcount:
+                conn.execute(
+                    "INSERT INTO workers (worker, units, last_seen) VALUES (?, 1, ?) "
+                    "ON CONFLICT(worker) DO UPDATE SET units = units + 1, last_seen = excluded.last_seen",
+                    (worker, time.time()))
+        conn.close()
+
+    def report_worker(self, worker, throttling):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO workers (worker, last_seen, throttling) VALUES (?, ?, ?) "
+                "ON CONFLICT(worker) DO UPDATE SET last_seen = excluded.last_seen, throttling = excluded.throttling",
+                (worker, time.time(), json.dumps(throttling)))
+        conn.close()
+
+    def counts(self):
+        conn = self._connect()
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM units GROUP BY status").fetchall())
+        conn.close()
+        return {s: counts.get(s, 0) for s in ("pending", "leased", "done")}
+
+    def results(self):
+        conn = self._connect()
+        rows = conn.execute("SELECT results_json FROM units WHERE status = 'done' ORDER BY id").fetchall()
+        conn.close()
+        return [r for row in rows for r in json.loads(row["results_json"])]
+
+    def workers(self):
+        conn = self._connect()
+        rows = conn.execute("SELECT * FROM workers ORDER BY worker").fetchall()
+        conn.close()
+        return [{"worker": r["worker"], "units": r["units"],
+                 "throttling": json.loads(r["throttling"]) if r["throttling"] else None} for r in rows]
+
+
+class LeaseRenewer:
+    """Background thread renewing a worker's leases until stopped."""
+
+    def __init__(self, queue, worker):
+        self.queue = queue
+        self.worker = worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(RENEW_INTERVAL):
+            self.queue.renew(self.worker)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
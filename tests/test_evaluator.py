@@ -0,0 +1,116 @@
+"""The local evaluator must match exactly what custodian's own filters match.
+
+Each case runs the same policy through evaluator.evaluate and through c7n's
+filter_resources over the same resources, and compares the matched ids and
+their c7n:MatchedFilters annotations. No AWS calls are made.
+"""
+
+import os
+import sys
+
+import pytest
+from c7n.config import Config
+from c7n.policy import Policy
+from c7n.resources import load_resources
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+import evaluator  # noqa: E402
+
+load_resources(("aws.ec2", "aws.ebs"))
+
+INSTANCES = [
+    {"InstanceId": "i-1", "InstanceType": "t2.micro", "CpuOptions": {"CoreCount": 1},
+     "Tags": [{"Key": "Owner", "Value": "alice"}, {"Key": "Env", "Value": " Prod "}]},
+    {"InstanceId": "i-2", "InstanceType": "m5.large", "CpuOptions": {"CoreCount": 2},
+     "Tags": [{"Key": "Env", "Value": "dev"}]},
+    {"InstanceId": "i-3", "InstanceType": "T2.MICRO", "CpuOptions": {"CoreCount": "4"}, "Tags": []},
+    {"InstanceId": "i-4", "InstanceType": "c5.xlarge", "SecurityGroups": [{"GroupId": "sg-1"}, {"GroupId": "sg-2"}],
+     "Tags": [{"Key": "Owner", "Value": ""}, {"Key": "Env", "Value": "staging"}]},
+]
+
+VOLUMES = [
+    {"VolumeId": "vol-1", "Encrypted": False, "Size": 8, "Attachments": [], "Tags": []},
+    {"VolumeId": "vol-2", "Encrypted": True, "Size": 100, "Attachments": [{"InstanceId": "i-1"}],
+     "Tags": [{"Key": "Owner", "Value": "bob"}]},
+    {"VolumeId": "vol-3", "Encrypted": True, "Size": "500", "Attachments": [],
+     "Tags": [{"Key": "Owner", "Value": "carol"}]},
+]
+
+CASES = {
+    "tag absent": ("aws.ec2", [{"tag:Owner": "absent"}]),
+    "tag present": ("aws.ec2", [{"tag:Owner": "present"}]),
+    "tag empty": ("aws.ec2", [{"tag:Owner": "empty"}]),
+    "tag not-null": ("aws.ec2", [{"tag:Owner": "not-null"}]),
+    "tag glob": ("aws.ec2", [{"type": "value", "key": "tag:Env", "op": "glob", "value": "*ev"}]),
+    "tag normalize": ("aws.ec2", [{"type": "value", "key": "tag:Env", "value": "prod",
+                                   "value_type": "normalize"}]),
+    "normalize does not touch the value": ("aws.ec2", [{"type": "value", "key": "InstanceType",
+                                                        "value": "T2.MICRO", "value_type": "normalize"}]),
+    "regex is case-insensitive": ("aws.ec2", [{"type": "value", "key": "InstanceType", "op": "regex",
+                                               "value": "t2\\..*"}]),
+    "regex-case": ("aws.ec2", [{"type": "value", "key": "InstanceType", "op": "regex-case", "value": "t2\\..*"}]),
+    "integer": ("aws.ec2", [{"type": "value", "key": "CpuOptions.CoreCount", "op": "ge", "value": 2,
+                             "value_type": "integer"}]),
+    "float": ("aws.ebs", [{"type": "value", "key": "Size", "op": "gt", "value": 50.5, "value_type": "float"}]),
+    "size": ("aws.ebs", [{"type": "value", "key": "Attachments", "value": 0, "value_type": "size"}]),
+    "size of missing key": ("aws.ec2", [{"type": "value", "key": "SecurityGroups", "op": "lt", "value": 2,
+                                         "value_type": "size"}]),
+    "in": ("aws.ec2", [{"type": "value", "key": "InstanceType", "op": "in", "value": ["t2.micro", "c5.xlarge"]}]),
+    "not-in on a missing tag": ("aws.ec2", [{"type": "value", "key": "tag:Owner", "op": "not-in",
+                                             "value": ["alice"]}]),
+    "or": ("aws.ec2", [{"or": [{"tag:Owner": "absent"}, {"InstanceType": "m5.large"}]}]),
+    "not": ("aws.ec2", [{"not": [{"tag:Owner": "present"}]}]),
+    "not of several (and)": ("aws.ec2", [{"not": [{"tag:Owner": "present"}, {"tag:Env": "dev"}]}]),
+    "and inside or": ("aws.ebs", [{"or": [{"and": [{"Encrypted": False}, {"Attachments": "empty"}]},
+                                          {"tag:Owner": "bob"}]}]),
+    "or inside not": ("aws.ebs", [{"not": [{"or": [{"Encrypted": False}, {"tag:Owner": "carol"}]}]}]),
+    "same key twice": ("aws.ec2", [{"tag:Owner": "alice"}, {"tag:Owner": "present"}]),
+    "same filter twice": ("aws.ec2", [{"tag:Owner": "present"}, {"or": [{"tag:Owner": "present"},
+                                                                         {"tag:Env": "dev"}]}]),
+    "failed and inside or": ("aws.ec2", [{"or": [{"and": [{"tag:Owner": "present"}, {"tag:Env": "dev"}]},
+                                                 {"tag:Env": "staging"}, {"InstanceType": "t2.micro"}]}]),
+    "or and implicit and": ("aws.ec2", [{"or": [{"tag:Env": "dev"}, {"tag:Env": "staging"}]},
+                                        {"type": "value", "key": "CpuOptions.CoreCount", "value": "absent"}]),
+}
+
+
+def custodian_matches(resource_type, filters, resources):
+    policy = Policy({"name": "case", "resource": resource_type, "filters": filters},
+                    Config.empty(region="us-east-1", account_id="123456789012"), session_factory=None)
+    return policy.resource_manager.filter_resources([dict(r) for r in resources])
+
+
+def summary(resources, id_key):
+    # Custodian's not block returns its resources in set order, so order is not compared.
+    return sorted((r[id_key], r.get(evaluator.ANNOTATION_KEY) or []) for r in resources)
+
+
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_matches_custodian(case):
+    resource_type, filters = CASES[case]
+    resources, id_key = (INSTANCES, "InstanceId") if resource_type == "aws.ec2" else (VOLUMES, "VolumeId")
+    policy = {"name": "case", "resource": resource_type, "filters": filters}
+
+    local = evaluator.evaluate([policy], resources)["case"]
+
+    assert summary(local, id_key) == summary(custodian_matches(resource_type, filters, resources), id_key)
+
+
+def test_policies_sharing_filters_match_custodian_each():
+    policies = [{"name": name, "resource": "aws.ec2", "filters": CASES[name][1]}
+                for name in ("tag absent", "or", "not")]
+
+    local = evaluator.evaluate(policies, INSTANCES)
+
+    for p in policies:
+        expected = custodian_matches("aws.ec2", p["filters"], INSTANCES)
+        assert summary(local[p["name"]], "InstanceId") == summary(expected, "InstanceId")
+
+
+@pytest.mark.parametrize("f", [
+    {"type": "marked-for-op", "op": "stop"},
+    {"type": "value", "key": "LaunchTime", "value_type": "age", "op": "gt", "value": 30},
+    {"type": "value", "key": "Name", "value_from": {"url": "s3://bucket/list.txt"}},
+])
+def test_unsupported_filters_are_left_to_custodian(f):
+    assert not evaluator.supported({"name": "case", "resource": "aws.ec2", "filters": [f]})